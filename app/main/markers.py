@@ -0,0 +1,128 @@
+""" This module is responsible for building the marker payload served to the map from the listings csv. """
+import csv
+import gzip
+import hashlib
+import io
+import json
+import os
+import threading
+from dwellist.metrics import metrics
+from .spatial import ClusterIndex, MarkerIndex
+
+try:
+    import brotli
+
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+
+
+# The listing fields script.js reads for each marker
+MARKER_FIELDS = (
+    "id",
+    "url",
+    "area",
+    "type",
+    "latitude",
+    "longitude",
+    "room_1_price",
+    "bills_included",
+    "available",
+    "main_image",
+    "date_scraped",
+)
+
+
+class MarkerPayload:
+    """One version of the markers: serialised JSON, its ETag, pre-compressed encodings and index"""
+
+    __slots__ = ("etag", "bodies", "index", "_clusters", "_lock")
+
+    def __init__(self, body: bytes, etag: str, index: MarkerIndex):
+        self.etag = etag
+        self.index = index
+        self._clusters = None
+        self._lock = threading.Lock()
+        self.bodies = {"identity": body, "gzip": gzip.compress(body, compresslevel=6)}
+        if BROTLI_AVAILABLE:
+            self.bodies["br"] = brotli.compress(body)
+
+    @property
+    def clusters(self) -> ClusterIndex:
+        """Cluster levels for this version of the markers, built on first use"""
+        if self._clusters is None:
+            with self._lock:
+                if self._clusters is None:
+                    with metrics.timer("markers.clusters"):
+                        self._clusters = ClusterIndex(self.index)
+        return self._clusters
+
+
+class MarkerCache:
+    """
+    Marker payload built from the listings csv, rebuilt only when the csv changes
+
+    Each request costs a stat of the csv. When its size or modification time changes the file
+    is hashed, and only if the contents differ is it parsed, projected to MARKER_FIELDS,
+    serialised, compressed and indexed again.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: path to the listings csv
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._stat = None
+        self._digest = None
+        self._payload = None
+
+    def get(self) -> MarkerPayload:
+        """
+        Get the marker payload for the current contents of the csv
+
+        :return: MarkerPayload
+        """
+        stat = self._get_stat()
+        if self._payload is not None and stat == self._stat:
+            return self._payload
+        with self._lock:
+            if self._payload is None or stat != self._stat:
+                with metrics.timer("markers.refresh"):
+                    self._refresh(stat)
+            return self._payload
+
+    def preload(self) -> None:
+        """Build the payload, index and clusters now, e.g. before a server forks its workers"""
+        self.get().clusters
+
+    def _get_stat(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def _refresh(self, stat) -> None:
+        content = b""
+        if stat is not None:
+            with open(self.path, "rb") as csv_file:
+                content = csv_file.read()
+        digest = hashlib.sha256(content).hexdigest()
+        self._stat = stat
+        if self._payload is not None and digest == self._digest:
+            # Touched but not changed
+            return
+        self._digest = digest
+        rows = self._read_rows(content)
+        markers = [{field: row.get(field, "") for field in MARKER_FIELDS} for row in rows]
+        body = json.dumps(markers, separators=(",", ":")).encode("utf-8")
+        self._payload = MarkerPayload(
+            body, etag=digest[:32], index=MarkerIndex(rows, MARKER_FIELDS)
+        )
+
+    @staticmethod
+    def _read_rows(content: bytes) -> list:
+        if not content:
+            return []
+        return list(csv.DictReader(io.StringIO(content.decode("utf-8"), newline="")))
@@ -1,27 +1,140 @@
+import datetime
+import json
 import os
-import csv
-from flask import render_template, jsonify
+import time
+import zlib
+from flask import g, jsonify, render_template, request, Response
+from dwellist.metrics import metrics
 from . import main
+from .markers import MarkerCache
 
+marker_cache = MarkerCache(
+    os.environ.get("LISTINGS_CSV", os.path.join("dwellist", "data", "spareroom_listing.csv"))
+)
 
-@main.route("/")
-def index():
-    return render_template("index.html")
+RUN_SUMMARY = os.environ.get(
+    "RUN_SUMMARY", os.path.join("dwellist", "data", "run_summary.json")
+)
+
+DEFAULT_PAGE_SIZE = 500
+MAX_PAGE_SIZE = 5000
+
+
+@main.before_app_request
+def start_timer():
+    g.request_start = time.perf_counter()
 
 
-def read_csv():
-    """Load data as a list of dictionaries"""
-    # Read CSV file
-    with open("scraper/data/spareroom_listing.csv", "r", encoding="utf-8") as csv_file:
-        data = list(csv.DictReader(csv_file))
+@main.after_app_request
+def record_request(response):
+    if "request_start" in g and request.endpoint:
+        metrics.observe(f"http.{request.endpoint}", time.perf_counter() - g.request_start)
+        metrics.increment(f"http.status.{response.status_code}")
+        metrics.increment("http.bytes", response.content_length or 0)
+    return response
 
-    # Move back to app directory
-    return data
+
+@main.route("/metrics")
+def get_metrics():
+    """Return this worker's request metrics and the summary of the last scrape run"""
+    last_run = None
+    try:
+        with open(RUN_SUMMARY, "r", encoding="utf-8") as summary_file:
+            last_run = json.load(summary_file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        pass
+    return jsonify({"pid": os.getpid(), "app": metrics.summary(), "last_run": last_run})
+
+
+@main.route("/")
+def index():
+    return render_template("index.html")
 
 
 # Route to fetch marker data
 @main.route("/get_markers")
 def get_markers():
-    """Return the marker data as a JSON object"""
-    data = read_csv()
-    return jsonify(data)
+    """Return the marker data as a JSON object, or 304 if the client's copy is current"""
+    payload = marker_cache.get()
+    if request.if_none_match.contains(payload.etag):
+        response = Response(status=304)
+    else:
+        encoding = (
+            request.accept_encodings.best_match(list(payload.bodies), default="identity")
+            or "identity"
+        )
+        response = Response(payload.bodies[encoding], mimetype="application/json")
+        if encoding != "identity":
+            response.headers["Content-Encoding"] = encoding
+    response.set_etag(payload.etag)
+    response.headers["Vary"] = "Accept-Encoding"
+    # Let browsers keep the payload but revalidate it on every page load
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+def _parse_bbox(value: str) -> tuple:
+    """Parse a west,south,east,north bbox query parameter"""
+    west, south, east, north = (float(coordinate) for coordinate in value.split(","))
+    if west > east or south > north:
+        raise ValueError("bbox must be west,south,east,north")
+    return (west, south, east, north)
+
+
+def _parse_date(value: str) -> datetime.date:
+    return datetime.date.fromisoformat(value)
+
+
+@main.route("/api/markers")
+def query_markers():
+    """
+    Return one page of the markers inside a viewport that match the filters
+
+    Query parameters: bbox (west,south,east,north), min_price, max_price, room_type,
+    bills_included, since and until (YYYY-MM-DD), offset and limit.
+    """
+    args = request.args
+    query = {
+        "bbox": args.get("bbox", type=_parse_bbox),
+        "min_price": args.get("min_price", type=int),
+        "max_price": args.get("max_price", type=int),
+        "room_type": args.get("room_type") or None,
+        "bills_included": args.get("bills_included") or None,
+        "since": args.get("since", type=_parse_date),
+        "until": args.get("until", type=_parse_date),
+    }
+    # Werkzeug returns None for values that fail to convert
+    invalid = [key for key, value in query.items() if value is None and args.get(key)]
+    if invalid:
+        return jsonify({"error": f"Invalid query parameters: {', '.join(invalid)}"}), 400
+    query["offset"] = max(args.get("offset", 0, type=int), 0)
+    query["limit"] = min(max(args.get("limit", DEFAULT_PAGE_SIZE, type=int), 0), MAX_PAGE_SIZE)
+
+    payload = marker_cache.get()
+    total, markers = payload.index.query(**query)
+    response = jsonify(
+        {"total": total, "offset": query["offset"], "limit": query["limit"], "markers": markers}
+    )
+    # Results only change with the csv, so the same query can be revalidated cheaply
+    response.set_etag(f"{payload.etag}-{zlib.crc32(request.query_string):08x}")
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
+
+
+@main.route("/api/clusters")
+def query_clusters():
+    """
+    Return the marker clusters inside a viewport at a zoom level
+
+    Query parameters: bbox (west,south,east,north) and zoom.
+    """
+    bbox = request.args.get("bbox", type=_parse_bbox)
+    zoom = request.args.get("zoom", type=int)
+    if bbox is None or zoom is None:
+        return jsonify({"error": "bbox and zoom are required"}), 400
+
+    payload = marker_cache.get()
+    response = jsonify({"zoom": zoom, "clusters": payload.clusters.clusters(bbox, zoom)})
+    response.set_etag(f"{payload.etag}-{zlib.crc32(request.query_string):08x}")
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
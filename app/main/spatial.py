@@ -0,0 +1,296 @@
+""" This module is responsible for answering viewport, filter and cluster queries over the markers in memory. """
+import datetime
+import math
+import re
+import statistics
+from collections import defaultdict
+
+ROOM_PRICE_COLUMN = re.compile(r"room_(\d+)_price$")
+
+
+def _to_float(value) -> float:
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return None if math.isnan(value) else value
+
+
+def _to_price(value) -> int:
+    """Parse a csv room price ("1,050", "974" or "974.0") to whole pounds, or None"""
+    price = _to_float(str(value).replace(",", "")) if value not in (None, "") else None
+    return None if price is None else int(price)
+
+
+def _to_date(value) -> datetime.date:
+    try:
+        return datetime.datetime.strptime(value, "%d-%m-%Y").date()
+    except (TypeError, ValueError):
+        return None
+
+
+class MarkerIndex:
+    """
+    Uniform grid index over marker coordinates
+
+    Markers are bucketed into cell_size degree cells, so a viewport query only visits the cells
+    it overlaps. Prices, room types and scrape dates are parsed once when the index is built and
+    the remaining filters are checked on the candidates the grid returns. Markers without
+    coordinates cannot be shown on the map and are left out.
+    """
+
+    def __init__(self, rows: list, fields: tuple, cell_size: float = 0.01):
+        """
+        :param rows: listing rows read from the csv, as dictionaries of strings
+        :param fields: fields of each row returned by queries
+        :param cell_size: grid cell size in degrees
+        """
+        self.cell_size = cell_size
+        self.markers = []
+        self.latitudes = []
+        self.longitudes = []
+        self.prices = []
+        self.room_types = []
+        self.bills_included = []
+        self.dates = []
+        self.cells = defaultdict(list)
+
+        price_columns = []
+        if rows:
+            price_columns = sorted(
+                (int(match.group(1)), column)
+                for column in rows[0]
+                if (match := ROOM_PRICE_COLUMN.match(column))
+            )
+        for row in rows:
+            latitude = _to_float(row.get("latitude"))
+            longitude = _to_float(row.get("longitude"))
+            if latitude is None or longitude is None:
+                continue
+            position = len(self.markers)
+            self.markers.append({field: row.get(field, "") for field in fields})
+            self.latitudes.append(latitude)
+            self.longitudes.append(longitude)
+            self.prices.append(
+                [
+                    price
+                    for _, column in price_columns
+                    if (price := _to_price(row.get(column))) is not None
+                ]
+            )
+            self.room_types.append(
+                {
+                    row[f"room_{room_no}_type"].lower()
+                    for room_no, _ in price_columns
+                    if row.get(f"room_{room_no}_type")
+                }
+            )
+            self.bills_included.append(row.get("bills_included", ""))
+            self.dates.append(_to_date(row.get("date_scraped")))
+            self.cells[self._cell(latitude, longitude)].append(position)
+
+    def __len__(self):
+        return len(self.markers)
+
+    def _cell(self, latitude: float, longitude: float) -> tuple:
+        return (math.floor(longitude / self.cell_size), math.floor(latitude / self.cell_size))
+
+    def _candidates(self, bbox) -> list:
+        """Positions of the markers in the cells a (west, south, east, north) bbox overlaps"""
+        if bbox is None:
+            return range(len(self.markers))
+        west, south, east, north = bbox
+        min_x, min_y = self._cell(south, west)
+        max_x, max_y = self._cell(north, east)
+        positions = []
+        if (max_x - min_x + 1) * (max_y - min_y + 1) > len(self.cells):
+            # Zoomed out further than the data: scanning the occupied cells is cheaper
+            for (x, y), cell in self.cells.items():
+                if min_x <= x <= max_x and min_y <= y <= max_y:
+                    positions.extend(cell)
+        else:
+            for x in range(min_x, max_x + 1):
+                for y in range(min_y, max_y + 1):
+                    positions.extend(self.cells.get((x, y), ()))
+        # Keep results in csv order so pages are stable between requests
+        positions.sort()
+        return positions
+
+    def query(
+        self,
+        bbox: tuple = None,
+        min_price: int = None,
+        max_price: int = None,
+        room_type: str = None,
+        bills_included: str = None,
+        since: datetime.date = None,
+        until: datetime.date = None,
+        offset: int = 0,
+        limit: int = None,
+    ) -> tuple:
+        """
+        Find the markers inside a viewport that match every filter given
+
+        :param bbox: (west, south, east, north) in degrees
+        :param min_price: lowest monthly price of any room in the listing
+        :param max_price: highest monthly price of any room in the listing
+        :param room_type: room type, e.g. double, single or whole property
+        :param bills_included: "Yes" or "No"
+        :param since: earliest scrape date
+        :param until: latest scrape date
+        :param offset: number of matching markers to skip
+        :param limit: maximum number of markers to return
+        :return: (total number of matching markers, list of markers on the requested page)
+        """
+        room_type = room_type.lower() if room_type else None
+        matches = []
+        for position in self._candidates(bbox):
+            if bbox is not None:
+                west, south, east, north = bbox
+                if not (
+                    south <= self.latitudes[position] <= north
+                    and west <= self.longitudes[position] <= east
+                ):
+                    continue
+            if min_price is not None or max_price is not None:
+                if not any(
+                    (min_price is None or price >= min_price)
+                    and (max_price is None or price <= max_price)
+                    for price in self.prices[position]
+                ):
+                    continue
+            if room_type and room_type not in self.room_types[position]:
+                continue
+            if bills_included and self.bills_included[position] != bills_included:
+                continue
+            if since or until:
+                date = self.dates[position]
+                if date is None or (since and date < since) or (until and date > until):
+                    continue
+            matches.append(position)
+
+        page = matches[offset:] if limit is None else matches[offset : offset + limit]
+        return len(matches), [self.markers[position] for position in page]
+
+
+def _project(latitude: float, longitude: float) -> tuple:
+    """Project to Web Mercator, scaled to the unit square"""
+    sin = math.sin(math.radians(max(min(latitude, 85.0511), -85.0511)))
+    y = 0.5 - 0.25 * math.log((1 + sin) / (1 - sin)) / math.pi
+    return (longitude / 360 + 0.5, y)
+
+
+def _unproject(x: float, y: float) -> tuple:
+    latitude = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y))))
+    return (latitude, (x - 0.5) * 360)
+
+
+class ClusterIndex:
+    """
+    Hierarchical grid of marker clusters, one level per zoom
+
+    At each zoom the map is cut into cells radius pixels wide and every cell holds at most one
+    cluster, built from the clusters of the zoom below it. Every level is built once per dataset
+    version, so a query only visits the cells in view and returns at most one feature per cell.
+    Above max_zoom the markers are returned individually.
+    """
+
+    def __init__(
+        self, index: MarkerIndex, radius: int = 80, extent: int = 256, max_zoom: int = 16
+    ):
+        """
+        :param index: MarkerIndex of the markers to cluster
+        :param radius: cluster cell size in pixels
+        :param extent: tile size in pixels
+        :param max_zoom: highest zoom at which markers are clustered
+        """
+        self.index = index
+        self.radius = radius
+        self.extent = extent
+        self.max_zoom = max_zoom
+        self.levels = {}
+
+        # Leaves: (x, y, count, prices, marker position); a listing's price is its cheapest room
+        items = []
+        for position in range(len(index)):
+            x, y = _project(index.latitudes[position], index.longitudes[position])
+            prices = index.prices[position]
+            items.append((x, y, 1, [min(prices)] if prices else [], position))
+        self.levels[max_zoom + 1] = self._grid(items, max_zoom + 1)
+
+        for zoom in range(max_zoom, -1, -1):
+            cells = defaultdict(list)
+            for item in items:
+                cells[self._cell(item[0], item[1], zoom)].append(item)
+            items = []
+            for children in cells.values():
+                if len(children) == 1:
+                    items.append(children[0])
+                    continue
+                count = sum(child[2] for child in children)
+                x = sum(child[0] * child[2] for child in children) / count
+                y = sum(child[1] * child[2] for child in children) / count
+                prices = [price for child in children for price in child[3]]
+                items.append((x, y, count, prices, None))
+            self.levels[zoom] = self._grid(items, zoom)
+
+    def _cell_size(self, zoom: int) -> float:
+        return self.radius / (self.extent * 2**zoom)
+
+    def _cell(self, x: float, y: float, zoom: int) -> tuple:
+        cell_size = self._cell_size(zoom)
+        return (math.floor(x / cell_size), math.floor(y / cell_size))
+
+    def _grid(self, items: list, zoom: int) -> dict:
+        """Turn the items of a zoom level into its cell -> feature grid"""
+        grid = {}
+        for x, y, count, prices, position in items:
+            latitude, longitude = _unproject(x, y)
+            feature = {
+                "latitude": latitude,
+                "longitude": longitude,
+                "count": count,
+                "median_price": statistics.median(prices) if prices else None,
+            }
+            if position is not None:
+                feature["marker"] = self.index.markers[position]
+            grid.setdefault(self._cell(x, y, zoom), []).append(feature)
+        return grid
+
+    def clusters(self, bbox: tuple, zoom: int) -> list:
+        """
+        Get the clusters and single markers inside a viewport
+
+        :param bbox: (west, south, east, north) in degrees
+        :param zoom: map zoom level
+        :return: list of features with latitude, longitude, count and median_price; features
+            for a single listing also carry its marker
+        """
+        zoom = max(0, min(int(zoom), self.max_zoom + 1))
+        grid = self.levels[zoom]
+        west, south, east, north = bbox
+        min_x, min_y = self._cell(*_project(north, west), zoom)
+        max_x, max_y = self._cell(*_project(south, east), zoom)
+
+        features = []
+        if (max_x - min_x + 1) * (max_y - min_y + 1) > len(grid):
+            cells = [
+                cell
+                for (x, y), cell in grid.items()
+                if min_x <= x <= max_x and min_y <= y <= max_y
+            ]
+        else:
+            cells = [
+                grid[(x, y)]
+                for x in range(min_x, max_x + 1)
+                for y in range(min_y, max_y + 1)
+                if (x, y) in grid
+            ]
+        for cell in cells:
+            features.extend(
+                feature
+                for feature in cell
+                if south <= feature["latitude"] <= north
+                and west <= feature["longitude"] <= east
+            )
+        return features
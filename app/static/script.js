@@ -80,12 +80,14 @@ var defaultNewMarkerIcon = L.icon({
 
 
 // Function to add markers to the map
-function addMarkers(data) {
+function addMarkers(data, clearLayers = true) {
 
     // Get the current date and time
     const currentDate = new Date();
     // Clear the markers on the map
-    markersLayer.clearLayers();
+    if (clearLayers) {
+        markersLayer.clearLayers();
+    }
 
     // Ensure each marker is plotted on the map
     data.forEach(
@@ -120,6 +122,10 @@ function addMarkers(data) {
             newMarker.on('click', function() {
                 markersLayer.eachLayer(
                     function(layer) {
+                        // Leave cluster markers as they are
+                        if (layer.options.icon instanceof L.DivIcon) {
+                            return;
+                        }
                         layer.setIcon(defaultMarkerIcon);
 
                         // Compare the two dates
@@ -139,19 +145,88 @@ function addMarkers(data) {
     );
 }
 
-// Create a function that filters markers based on the price range
-function filterMarkers(minPrice, maxPrice, billsIncluded) {
-    // Filter the markers based on the price range
-    var filteredMarkers = markersData.filter(
-        function(marker) {
-            // Create let variables for the price of the room cast to a integer
-            let roomPrice = parseInt(marker.room_1_price);
-            // Print a message to console stating whether the price is more than or less than the minimum price
-            return roomPrice >= minPrice && roomPrice <= maxPrice && billsIncluded === marker.bills_included;
+// Filters applied on the server, set from the filter form
+var activeFilters = {};
+// Markers fetched per request; a viewport's matches are fetched page by page until all are drawn
+var markerPageSize = 2000;
+var markerRequest = 0;
+
+// Draw server-side clusters, with single listings drawn as ordinary markers
+function addClusters(clusters) {
+    markersLayer.clearLayers();
+    var singles = [];
+    clusters.forEach(
+        function(cluster) {
+            if (cluster.count === 1) {
+                singles.push(cluster.marker);
+                return;
+            }
+            var medianPrice = cluster.median_price ? "£" + Math.round(cluster.median_price) : '';
+            var clusterMarker = L.marker([cluster.latitude, cluster.longitude], {
+                icon: L.divIcon({
+                    className: 'marker-cluster',
+                    html: `<div><span>${cluster.count}</span><small>${medianPrice}</small></div>`,
+                    iconSize: [48, 48]
+                })
+            });
+            // Zoom in on the cluster when it is clicked
+            clusterMarker.on('click', function() {
+                map.setView(clusterMarker.getLatLng(), map.getZoom() + 2);
+            });
+            clusterMarker.addTo(markersLayer);
         }
     );
+    addMarkers(singles, false);
+}
+
+// Fetch what is visible in the current viewport: clusters, or the markers matching the active filters
+function loadMarkers() {
+    var bounds = map.getBounds();
+    var filtered = Object.keys(activeFilters).length > 0;
+    var params = new URLSearchParams(activeFilters);
+    params.set('bbox', [bounds.getWest(), bounds.getSouth(), bounds.getEast(), bounds.getNorth()]
+        .map(function(coordinate) { return coordinate.toFixed(5); }).join(','));
 
-    return filteredMarkers;
+    // Ignore responses to viewports the map has already moved away from
+    var request = ++markerRequest;
+    if (filtered) {
+        loadMarkerPage(params, 0, request);
+        return;
+    }
+    params.set('zoom', map.getZoom());
+    fetch('/api/clusters?' + params.toString())
+        .then(response => response.json())
+        .then(data => {
+            if (request !== markerRequest) {
+                return;
+            }
+            addClusters(data.clusters);
+        })
+        .catch(error => {
+            console.error('Error:', error);
+        });
+}
+
+// Fetch one page of the markers matching the active filters, then the next until the total is reached
+function loadMarkerPage(params, offset, request) {
+    params.set('offset', offset);
+    params.set('limit', markerPageSize);
+    fetch('/api/markers?' + params.toString())
+        .then(response => response.json())
+        .then(data => {
+            if (request !== markerRequest) {
+                return;
+            }
+            markersData = offset === 0 ? data.markers : markersData.concat(data.markers);
+            addMarkers(data.markers, offset === 0);
+            var nextOffset = offset + data.markers.length;
+            if (data.markers.length > 0 && nextOffset < data.total) {
+                loadMarkerPage(params, nextOffset, request);
+            }
+        })
+        .catch(error => {
+            console.error('Error:', error);
+        });
 }
 
 // JavaScript to handle filter card toggle
@@ -170,23 +245,21 @@ document.getElementById('filterButton').addEventListener('click',
         var minPrice = document.getElementById('minPrice').value;
         var maxPrice = document.getElementById('maxPrice').value;
         var billsIncluded = document.getElementById('billsIncluded').value;
-        console.log(minPrice);
-        console.log(maxPrice);
-        var filteredMarkers = filterMarkers(minPrice, maxPrice, billsIncluded);
-        console.log(filteredMarkers.length);
+        activeFilters = {};
+        if (minPrice) {
+            activeFilters.min_price = minPrice;
+        }
+        if (maxPrice) {
+            activeFilters.max_price = maxPrice;
+        }
+        if (billsIncluded) {
+            activeFilters.bills_included = billsIncluded;
+        }
         // Redraw the markers on the map
-        addMarkers(filteredMarkers);
+        loadMarkers();
     }
 );
 
-// Fetch data from Flask backend
-fetch('/get_markers')
-    .then(response => response.json())
-    .then(data => {
-        markersData = data;
-        // Add markers to the map based on data received from the server
-        addMarkers(data);
-    })
-    .catch(error => {
-        console.error('Error:', error);
-    });
\ No newline at end of file
+// Fetch the visible markers from the Flask backend whenever the map moves
+map.on('moveend', loadMarkers);
+loadMarkers();
@@ -0,0 +1,120 @@
+"""
+Benchmark the lxml parsers against the original Beautiful Soup paths
+
+Replays the saved listing pages in benchmarks/fixtures/detail, checks both paths produce the
+same fields, failing if any differ, and reports the mean parse time per page. Search pages in
+benchmarks/fixtures/search are timed for listing id extraction.
+
+Usage: python -m benchmarks.bench_parser [--iterations 200]
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+from bs4 import BeautifulSoup as Soup
+from dwellist.listing import Listing
+from dwellist.parser import extract_listing_ids, parse_search_results
+
+FIXTURE_DIR = os.path.join(os.path.dirname(__file__), "fixtures", "detail")
+SEARCH_FIXTURE_DIR = os.path.join(os.path.dirname(__file__), "fixtures", "search")
+DOMAIN = "https://www.spareroom.co.uk/flatshare/flatshare_detail.pl?flatshare_id="
+
+
+def load_fixtures(directory: str = FIXTURE_DIR) -> dict:
+    """Load the saved pages as raw bytes keyed by file name"""
+    fixtures = {}
+    for path in sorted(glob.glob(os.path.join(directory, "*.html"))):
+        with open(path, "rb") as fixture_file:
+            fixtures[os.path.basename(path)] = fixture_file.read()
+    return fixtures
+
+
+def parse_with_soup(content: bytes) -> dict:
+    return Listing(Soup(content, "lxml"), DOMAIN).to_dict()
+
+
+def parse_with_lxml(content: bytes) -> dict:
+    return Listing.from_html(content, DOMAIN).to_dict()
+
+
+def search_ids_with_soup(content: bytes) -> list:
+    articles = Soup(content, "lxml").find_all("article", class_="panel-listing-result")
+    return [
+        int(article.prettify().split("flatshare_id=")[1].split("&")[0])
+        for article in articles
+        if "listing-featured" not in str(article)
+    ]
+
+
+def search_ids_with_lxml(content: bytes) -> list:
+    return [card["id"] for card in parse_search_results(content) if not card["featured"]]
+
+
+def time_parser(parse, pages: list, iterations: int) -> float:
+    """Return the mean time in milliseconds to parse a single page"""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for content in pages:
+            parse(content)
+    end = time.perf_counter()
+    return (end - start) * 1000 / (iterations * len(pages))
+
+
+def compare_fields(fixtures: dict) -> list:
+    """Return (fixture, field, soup value, lxml value) for every field that differs"""
+    differences = []
+    for name, content in fixtures.items():
+        soup_fields = parse_with_soup(content)
+        lxml_fields = parse_with_lxml(content)
+        for field in list(soup_fields) + [f for f in lxml_fields if f not in soup_fields]:
+            if soup_fields.get(field) != lxml_fields.get(field):
+                differences.append(
+                    (name, field, soup_fields.get(field), lxml_fields.get(field))
+                )
+    return differences
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    arg_parser.add_argument("--iterations", type=int, default=200)
+    args = arg_parser.parse_args()
+
+    fixtures = load_fixtures()
+    pages = list(fixtures.values())
+
+    differences = compare_fields(fixtures)
+    for name, field, soup_value, lxml_value in differences:
+        print(f"{name}: {field} differs: soup={soup_value!r} lxml={lxml_value!r}")
+    search_pages = list(load_fixtures(SEARCH_FIXTURE_DIR).values())
+    search_differences = [
+        content
+        for content in search_pages
+        if search_ids_with_lxml(content) != search_ids_with_soup(content)
+        or extract_listing_ids(content) != search_ids_with_soup(content)
+    ]
+    if search_differences:
+        print(f"Listing ids differ between extractors on {len(search_differences)} search pages")
+    if differences or search_differences:
+        sys.exit("The lxml parsers do not match the BeautifulSoup paths")
+
+    soup_ms = time_parser(parse_with_soup, pages, args.iterations)
+    lxml_ms = time_parser(parse_with_lxml, pages, args.iterations)
+
+    print(f"{'Parser':<15}{'ms/page':>10}")
+    print(f"{'BeautifulSoup':<15}{soup_ms:>10.3f}")
+    print(f"{'lxml':<15}{lxml_ms:>10.3f}")
+    print(f"Speedup: {soup_ms / lxml_ms:.1f}x over {len(pages)} pages")
+
+    print()
+    print(f"{'Search ids':<15}{'ms/page':>10}")
+    for name, extractor in (
+        ("BeautifulSoup", search_ids_with_soup),
+        ("lxml cards", search_ids_with_lxml),
+        ("raw bytes", extract_listing_ids),
+    ):
+        print(f"{name:<15}{time_parser(extractor, search_pages, args.iterations):>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+"""
+Time each stage of a scrape offline against recorded pages
+
+Replays the fixtures in benchmarks/fixtures through a FixtureSite, so results are reproducible
+and no real data files are touched. Each stage is timed separately at every size and the
+results can be written as JSON to track regressions between commits. Before timing anything,
+the pipeline's refresh and overlapping search behaviour is checked, and the run fails if either
+is wrong.
+
+Usage: python -m benchmarks.bench_pipeline [--sizes 10 100 1000 10000] [--repeat 3] [--json results.json]
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from benchmarks.fixture_site import FixtureSite, LISTINGS_PER_PAGE, SEARCH_RESULTS_URL
+from dwellist.fetcher import AsyncFetcher
+from dwellist.known_ids import KnownListingIds
+from dwellist.listing import Listing
+from dwellist.parser import parse_listing
+from dwellist.pipeline import ScrapePipeline
+from dwellist.scraper import SpareRoomScraper
+from dwellist.storage import ListingStore
+from dwellist.utilities import add_new_listings
+
+DEFAULT_SIZES = (10, 100, 1000, 10000)
+
+CONFIG = {
+    "search_term": "London",
+    "sort_by": "days_since_placed",
+    "max_concurrency": 50,
+    "requests_per_second": 0,
+    "max_retries": 0,
+    "parse_mode": "thread",
+    "fetch_workers": 20,
+}
+
+
+def time_stage(run, repeat: int, setup=None) -> float:
+    """Return the best of repeat timings of run(), calling setup() untimed before each"""
+    best = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def parse_listings_parallel(pages: list, domain: str) -> list:
+    """Parse raw listing pages in a pool of worker processes, one per CPU"""
+    workers = os.cpu_count() or 1
+    chunksize = max(1, len(pages) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        records = executor.map(partial(parse_listing, domain=domain), pages, chunksize=chunksize)
+        return [Listing.from_record(record) for record in records]
+
+
+def benchmark_size(listing_count: int, repeat: int, directory: str) -> dict:
+    """Time every stage for listing_count listings and return seconds per stage"""
+    site = FixtureSite(listing_count)
+    config = {**CONFIG, "listings_to_scrape": listing_count}
+    page_count = -(-listing_count // LISTINGS_PER_PAGE)
+    timings = {}
+
+    timings["start_search"] = time_stage(
+        lambda: asyncio.run(
+            SpareRoomScraper.create(config, AsyncFetcher(config, transport=site.transport()))
+        ),
+        repeat,
+    )
+    scraper = asyncio.run(
+        SpareRoomScraper.create(config, AsyncFetcher(config, transport=site.transport()))
+    )
+
+    timings["max_page_count"] = time_stage(scraper._get_max_page_count, repeat)
+
+    def reset_pages():
+        scraper.pages = []
+
+    timings["fetch_search_pages"] = time_stage(
+        lambda: asyncio.run(scraper.scrape_all_pages(page_count)), repeat, reset_pages
+    )
+
+    listing_ids = []
+    timings["get_listing_ids"] = time_stage(
+        lambda: listing_ids.__setitem__(
+            slice(None), scraper.get_listing_ids(KnownListingIds())
+        ),
+        repeat,
+    )
+
+    pages = []
+    timings["fetch_listings"] = time_stage(
+        lambda: pages.__setitem__(
+            slice(None), asyncio.run(scraper.scrape_all_listings(listing_ids))
+        ),
+        repeat,
+    )
+
+    listings = []
+    timings["parse_listings"] = time_stage(
+        lambda: listings.__setitem__(
+            slice(None), [Listing.from_html(page, scraper.domain) for page in pages]
+        ),
+        repeat,
+    )
+    timings["parse_listings_parallel"] = time_stage(
+        lambda: parse_listings_parallel(pages, scraper.domain), repeat
+    )
+
+    csv_path = os.path.join(directory, f"listings_{listing_count}.csv")
+    timings["persist_csv"] = time_stage(
+        lambda: add_new_listings(None, listings, csv_path), repeat
+    )
+
+    database_path = os.path.join(directory, f"listings_{listing_count}.db")
+    store = ListingStore(database_path)
+    timings["persist_sqlite"] = time_stage(lambda: store.add_listings(listings), repeat)
+    store.close()
+
+    def run_pipeline():
+        store = ListingStore(os.path.join(directory, f"pipeline_{listing_count}.db"))
+        fetcher = AsyncFetcher(config, transport=site.transport())
+        pipeline = ScrapePipeline(fetcher, store.add_listings, KnownListingIds(), config)
+        asyncio.run(pipeline.run([(scraper, page_count)]))
+        store.close()
+
+    def remove_pipeline_store():
+        for suffix in ("", "-wal", "-shm"):
+            path = os.path.join(directory, f"pipeline_{listing_count}.db{suffix}")
+            if os.path.exists(path):
+                os.remove(path)
+
+    timings["pipeline"] = time_stage(run_pipeline, repeat, remove_pipeline_store)
+
+    # The thread based crawler of the slow path, over the blocking requests session
+    with site.patch_requests():
+        threaded_scraper = SpareRoomScraper(config)
+        timings["crawl_threaded"] = time_stage(
+            lambda: threaded_scraper.crawl_threaded(KnownListingIds(), page_count), repeat
+        )
+    return timings
+
+
+def check_refresh(directory: str) -> list:
+    """
+    Reprice the site between two refresh runs sharing a response cache, and check every
+    listing is stored as the site now serves it, with a price history row for each change
+
+    :param directory: directory for the store and cache
+    :return: list of problems found, empty if the check passed
+    """
+    listing_count = 20
+    site = FixtureSite(listing_count)
+    config = {
+        **CONFIG,
+        "listings_to_scrape": listing_count,
+        "refresh": True,
+        # Every listing is stored after the first run, so an incremental stop would end the
+        # second run after its first page
+        "incremental": True,
+        "cache_dir": os.path.join(directory, "refresh_cache"),
+    }
+    store = ListingStore(os.path.join(directory, "refresh.db"))
+
+    def run():
+        fetcher = AsyncFetcher(config, transport=site.transport())
+        scraper = asyncio.run(SpareRoomScraper.create(config, fetcher))
+        pipeline = ScrapePipeline(
+            fetcher, store.add_listings, KnownListingIds.from_store(store), config, store
+        )
+        asyncio.run(pipeline.run([(scraper, -(-listing_count // LISTINGS_PER_PAGE))]))
+        return pipeline
+
+    run()
+    # The recorded search card and one of the recorded listing pages ask £1,050 pcm
+    site.replace("£1,050 pcm".encode(), "£1,090 pcm".encode())
+    pipeline = run()
+
+    problems = []
+    if pipeline.refreshed != listing_count:
+        problems.append(f"refreshed {pipeline.refreshed} of {listing_count} repriced listings")
+    stored = {listing.id: listing for listing in store.get_listings()}
+    for listing_id in site.listing_ids:
+        _, content = site.respond(SpareRoomScraper.domain + str(listing_id))
+        served = Listing.from_html(content, SpareRoomScraper.domain)
+        if listing_id not in stored or stored[listing_id].rooms != served.rooms:
+            problems.append(
+                f"{listing_id}: stored {getattr(stored.get(listing_id), 'rooms', None)}, "
+                f"site serves {served.rooms}"
+            )
+        history = store.get_price_history(listing_id)
+        if history and history[-1]["rooms"] != [tuple(room) for room in served.rooms]:
+            problems.append(f"{listing_id}: price history ends at {history[-1]['rooms']}")
+    store.close()
+    return problems
+
+
+def check_overlapping_searches() -> list:
+    """
+    Run two incremental searches whose first results pages are the same, and check the longer
+    one is not stopped early by the listings the other queued
+
+    :return: list of problems found, empty if the check passed
+    """
+    site = FixtureSite(30)
+    config = {**CONFIG, "listings_to_scrape": 100, "incremental": True}
+    fetcher = AsyncFetcher(config, transport=site.transport())
+    first_page = (SEARCH_RESULTS_URL, site.search_page(0))
+    # The first search covers one page of results, the second all three
+    searches = [
+        (SpareRoomScraper(config, fetcher, first_page), 1),
+        (SpareRoomScraper({**config, "search_term": "Hackney"}, fetcher, first_page), 3),
+    ]
+    saved = []
+    pipeline = ScrapePipeline(fetcher, saved.extend, KnownListingIds(), config)
+    asyncio.run(pipeline.run(searches))
+
+    missing = sorted(set(site.listing_ids) - {listing.id for listing in saved})
+    if missing:
+        return [f"{len(missing)} listings of the second search were not fetched: {missing}"]
+    return []
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    arg_parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    arg_parser.add_argument("--repeat", type=int, default=3)
+    arg_parser.add_argument("--json", help="file to write the results to, - for stdout")
+    args = arg_parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        problems = check_refresh(directory) + check_overlapping_searches()
+        if problems:
+            sys.exit("Pipeline checks failed:\n" + "\n".join(problems))
+        for listing_count in args.sizes:
+            for stage, seconds in benchmark_size(listing_count, args.repeat, directory).items():
+                results.append(
+                    {
+                        "stage": stage,
+                        "listings": listing_count,
+                        "seconds": round(seconds, 6),
+                        "ms_per_listing": round(seconds * 1000 / listing_count, 4),
+                    }
+                )
+
+    report = {
+        "benchmark": "pipeline",
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "repeat": args.repeat,
+        "results": results,
+    }
+
+    if args.json == "-":
+        json.dump(report, sys.stdout, indent=2)
+        return
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as json_file:
+            json.dump(report, json_file, indent=2)
+
+    print(f"{'Stage':<26}{'Listings':>10}{'Seconds':>12}{'ms/listing':>12}")
+    for result in results:
+        print(
+            f"{result['stage']:<26}{result['listings']:>10}"
+            f"{result['seconds']:>12.4f}{result['ms_per_listing']:>12.4f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""
+Load test /get_markers on the Flask dev server and on gunicorn
+
+Writes a synthetic listings csv, starts each server on it in turn and reports requests per
+second and latency percentiles for full downloads and for ETag revalidations.
+
+Usage: python -m benchmarks.bench_server [--listings 20000] [--concurrency 32] [--duration 10]
+"""
+import argparse
+import asyncio
+import csv
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVERS = {
+    "dev server": [sys.executable, "app.py"],
+    "gunicorn": [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "wsgi:app"],
+}
+
+
+def write_listings(path: str, count: int) -> None:
+    """Write a csv of count listings scattered over London"""
+    random.seed(0)
+    fields = [
+        "id",
+        "available",
+        "url",
+        "title",
+        "type",
+        "area",
+        "room_1_price",
+        "room_1_type",
+        "latitude",
+        "longitude",
+        "bills_included",
+        "main_image",
+        "date_scraped",
+    ]
+    with open(path, "w", newline="", encoding="utf-8") as csv_file:
+        writer = csv.DictWriter(csv_file, fields)
+        writer.writeheader()
+        for listing_id in range(count):
+            writer.writerow(
+                {
+                    "id": listing_id,
+                    "available": "Now",
+                    "url": f"https://www.spareroom.co.uk/{listing_id}",
+                    "title": "Double room in friendly flat share",
+                    "type": "Flat share",
+                    "area": "Hackney",
+                    "room_1_price": random.randint(500, 2000),
+                    "room_1_type": random.choice(["double", "single"]),
+                    "latitude": 51.3 + random.random() * 0.4,
+                    "longitude": -0.5 + random.random() * 0.7,
+                    "bills_included": random.choice(["Yes", "No"]),
+                    "main_image": f"https://photos.spareroom.co.uk/{listing_id}.jpg",
+                    "date_scraped": "01-05-2024",
+                }
+            )
+
+
+def start_server(command: list, csv_path: str, port: int, workers: int) -> subprocess.Popen:
+    env = {
+        **os.environ,
+        "LISTINGS_CSV": csv_path,
+        "PORT": str(port),
+        "HOST": "127.0.0.1",
+        "WEB_CONCURRENCY": str(workers),
+        "GUNICORN_ACCESS_LOG": "/dev/null",
+    }
+    return subprocess.Popen(
+        command,
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        # Own process group, so the dev server's reloader child is stopped with it
+        start_new_session=True,
+    )
+
+
+def wait_until_ready(url: str, timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url, timeout=30).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout} seconds")
+
+
+async def load_test(url: str, concurrency: int, duration: float, etag: str = None) -> dict:
+    """Request url from concurrency clients for duration seconds"""
+    headers = {"Accept-Encoding": "gzip"}
+    if etag:
+        headers["If-None-Match"] = etag
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+
+    async def client(http_client):
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                response = await http_client.get(url, headers=headers)
+                await response.aread()
+                if response.status_code not in (200, 304):
+                    errors += 1
+                    continue
+            except httpx.HTTPError:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=30) as http_client:
+        started = time.perf_counter()
+        await asyncio.gather(*(client(http_client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+
+    def percentile(fraction):
+        return latencies[int(fraction * (len(latencies) - 1))] * 1000 if latencies else 0
+
+    return {
+        "rps": len(latencies) / elapsed,
+        "p50": percentile(0.5),
+        "p99": percentile(0.99),
+        "errors": errors,
+    }
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    arg_parser.add_argument("--listings", type=int, default=20000)
+    arg_parser.add_argument("--concurrency", type=int, default=32)
+    arg_parser.add_argument("--duration", type=float, default=10)
+    arg_parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    arg_parser.add_argument("--port", type=int, default=5099)
+    args = arg_parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        csv_path = os.path.join(directory, "listings.csv")
+        write_listings(csv_path, args.listings)
+        url = f"http://127.0.0.1:{args.port}/get_markers"
+
+        print(f"{args.listings} listings, {args.concurrency} clients, {args.duration:.0f}s per run")
+        print(f"{'Server':<12}{'Request':<14}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}")
+        for name, command in SERVERS.items():
+            server = start_server(command, csv_path, args.port, args.workers)
+            try:
+                wait_until_ready(url)
+                etag = httpx.get(url).headers.get("ETag")
+                for request, request_etag in (("full", None), ("revalidate", etag)):
+                    result = asyncio.run(
+                        load_test(url, args.concurrency, args.duration, request_etag)
+                    )
+                    print(
+                        f"{name:<12}{request:<14}{result['rps']:>10.0f}"
+                        f"{result['p50']:>10.1f}{result['p99']:>10.1f}{result['errors']:>8}"
+                    )
+            finally:
+                os.killpg(server.pid, signal.SIGTERM)
+                server.wait()
+
+
+if __name__ == "__main__":
+    main()
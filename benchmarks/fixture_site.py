@@ -0,0 +1,129 @@
+"""
+Offline stand-in for SpareRoom built from the recorded pages in benchmarks/fixtures
+
+A FixtureSite serves any number of synthetic listings: search result pages are the recorded
+search page with its result cards renumbered, and each listing page is one of the recorded
+detail pages with its flatshare id swapped for the listing's. Both the async fetcher (through
+an httpx.MockTransport) and the blocking requests session (through a transport adapter) can be
+pointed at it, so a scrape runs end to end without touching the network.
+"""
+import glob
+import os
+import re
+from contextlib import contextmanager
+from unittest import mock
+from urllib.parse import parse_qs, urlsplit
+import httpx
+import requests
+from requests.adapters import BaseAdapter
+
+FIXTURE_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+# The live site redirects a new search to its results under a search id
+SEARCH_RESULTS_URL = "https://www.spareroom.co.uk/flatshare/search.pl?search_id=1283746501&"
+FIRST_LISTING_ID = 20_000_000
+LISTINGS_PER_PAGE = 10
+
+_listing_id = re.compile(rb"flatshare_id=(\d+)")
+_article = re.compile(rb"\s*<article\b.*?</article>", re.S)
+
+
+class FixtureSite:
+    """Synthetic search results and listing pages for listing_count listings"""
+
+    def __init__(self, listing_count: int):
+        self.listing_count = listing_count
+        self.requests = 0
+        # (old, new) byte replacements applied to every page served, see replace
+        self.replacements = []
+
+        self.detail_pages = []
+        for path in sorted(glob.glob(os.path.join(FIXTURE_DIR, "detail", "*.html"))):
+            with open(path, "rb") as fixture_file:
+                content = fixture_file.read()
+            self.detail_pages.append((content, _listing_id.search(content).group(1)))
+
+        with open(os.path.join(FIXTURE_DIR, "search", "search_page.html"), "rb") as fixture_file:
+            search_page = fixture_file.read()
+        articles = list(_article.finditer(search_page))
+        self._search_head = search_page[: articles[0].start()].replace(
+            b"<strong>436 </strong>", f"<strong>{listing_count} </strong>".encode()
+        )
+        self._search_tail = search_page[articles[-1].end() :]
+        self._featured = articles[0].group(0)
+        self._card = articles[1].group(0)
+        self._card_id = _listing_id.search(self._card).group(1)
+
+    @property
+    def listing_ids(self) -> range:
+        return range(FIRST_LISTING_ID, FIRST_LISTING_ID + self.listing_count)
+
+    def search_page(self, offset: int) -> bytes:
+        """The results page starting at offset, with a featured card first as on the live site"""
+        listing_ids = self.listing_ids[offset : offset + LISTINGS_PER_PAGE]
+        cards = b"".join(
+            self._card.replace(self._card_id, str(listing_id).encode())
+            for listing_id in listing_ids
+        )
+        return self._search_head + self._featured + cards + self._search_tail
+
+    def detail_page(self, listing_id: int) -> bytes:
+        content, fixture_id = self.detail_pages[listing_id % len(self.detail_pages)]
+        return content.replace(fixture_id, str(listing_id).encode())
+
+    def replace(self, old: bytes, new: bytes) -> None:
+        """Change the site: every page served from now on has old replaced by new"""
+        self.replacements.append((old, new))
+
+    def respond(self, url: str) -> tuple:
+        """Return (status code, body) for a SpareRoom URL"""
+        self.requests += 1
+        parts = urlsplit(url)
+        query = parse_qs(parts.query)
+        if parts.path.endswith("flatshare_detail.pl") and "flatshare_id" in query:
+            content = self.detail_page(int(query["flatshare_id"][0]))
+        elif parts.path.endswith("search.pl"):
+            content = self.search_page(int((query.get("offset") or ["0"])[0] or 0))
+        else:
+            return 404, b""
+        for old, new in self.replacements:
+            content = content.replace(old, new)
+        return 200, content
+
+    def transport(self) -> httpx.MockTransport:
+        """httpx transport for AsyncFetcher"""
+
+        def handler(request):
+            if "action=search" in str(request.url):
+                return httpx.Response(302, headers={"Location": SEARCH_RESULTS_URL})
+            status_code, content = self.respond(str(request.url))
+            return httpx.Response(
+                status_code, content=content, headers={"Content-Type": "text/html"}
+            )
+
+        return httpx.MockTransport(handler)
+
+    @contextmanager
+    def patch_requests(self):
+        """Route every requests.Session through the site while the context is open"""
+        adapter = _FixtureAdapter(self)
+        with mock.patch.object(requests.Session, "get_adapter", lambda session, url: adapter):
+            yield
+
+
+class _FixtureAdapter(BaseAdapter):
+    def __init__(self, site: FixtureSite):
+        super().__init__()
+        self.site = site
+
+    def send(self, request, **kwargs):
+        status_code, content = self.site.respond(request.url)
+        response = requests.Response()
+        response.status_code = status_code
+        response._content = content
+        response.url = SEARCH_RESULTS_URL if "action=search" in request.url else request.url
+        response.request = request
+        response.headers["Content-Type"] = "text/html"
+        return response
+
+    def close(self):
+        pass
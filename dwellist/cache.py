@@ -0,0 +1,259 @@
+""" This module is responsible for caching HTTP responses on disk between runs. """
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from dwellist.logger import DwellistLogger
+
+
+class CachedResponse:
+    """A cached response body with its validators"""
+
+    __slots__ = ("url", "content", "etag", "last_modified", "fresh")
+
+    def __init__(self, url, content, etag, last_modified, fresh):
+        self.url = url
+        self.content = content
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fresh = fresh
+
+    def validators(self) -> dict:
+        """Conditional request headers for revalidating this response"""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class ResponseCache:
+    """
+    Content addressed on-disk HTTP response cache
+
+    Bodies are zlib compressed and stored under the SHA-256 of their content, so identical
+    pages are stored once. A SQLite index maps each URL to its body, validators and fetch time.
+    Entries expire after the TTL for their page type and the least recently used are evicted
+    once the bodies exceed max_bytes. Cache hits only note their access time in memory; the
+    times are written to the index by the next put, touch, eviction or flush, so reads never
+    wait on a commit.
+    """
+
+    logger = DwellistLogger.get_logger()
+
+    DEFAULT_TTLS = {"search": 15 * 60, "detail": 24 * 60 * 60}
+
+    def __init__(self, directory: str, ttls: dict = None, max_bytes: int = 512 * 1024**2):
+        self.directory = directory
+        self.body_directory = os.path.join(directory, "bodies")
+        self.ttls = {**self.DEFAULT_TTLS, **(ttls or {})}
+        self.max_bytes = max_bytes
+        os.makedirs(self.body_directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        # URL -> access time of cache hits not yet written to the index
+        self._accessed = {}
+        self._connection = sqlite3.connect(
+            os.path.join(directory, "index.db"), check_same_thread=False
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                url TEXT PRIMARY KEY,
+                digest TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                fetched_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            """
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)"
+        )
+        self._connection.commit()
+        self.total_bytes = self._connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM (SELECT DISTINCT digest, size FROM responses)"
+        ).fetchone()[0]
+
+    @classmethod
+    def from_config(cls, config: dict):
+        """Create the cache described by the config, or None if caching is disabled"""
+        directory = config.get("cache_dir")
+        if not directory:
+            return None
+        return cls(
+            directory,
+            ttls=config.get("cache_ttl"),
+            max_bytes=config.get("cache_max_mb", 512) * 1024**2,
+        )
+
+    def get(self, url: str, page_type: str = None) -> CachedResponse:
+        """
+        Look up a URL in the cache
+
+        :param url: URL of the response
+        :param page_type: "search" or "detail", selects the TTL
+        :return: CachedResponse, or None if the URL is not cached
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT digest, etag, last_modified, fetched_at FROM responses WHERE url = ?",
+                (url,),
+            ).fetchone()
+            if row is None:
+                return None
+            digest, etag, last_modified, fetched_at = row
+            self._accessed[url] = time.time()
+
+        try:
+            with open(self._body_path(digest), "rb") as body_file:
+                content = zlib.decompress(body_file.read())
+        except (OSError, zlib.error) as e:
+            self.logger.debug("Dropping unreadable cache entry for %s: %s", url, e)
+            self._delete(url)
+            return None
+
+        ttl = self.ttls.get(page_type, min(self.ttls.values()))
+        fresh = time.time() - fetched_at < ttl
+        return CachedResponse(url, content, etag, last_modified, fresh)
+
+    def put(self, url: str, content: bytes, headers) -> None:
+        """
+        Store a response body and its validators
+
+        :param url: URL of the response
+        :param content: response body
+        :param headers: response headers
+        """
+        digest = hashlib.sha256(content).hexdigest()
+        body_path = self._body_path(digest)
+        compressed = None if os.path.exists(body_path) else zlib.compress(content)
+
+        now = time.time()
+        with self._lock:
+            if compressed is not None and not os.path.exists(body_path):
+                os.makedirs(os.path.dirname(body_path), exist_ok=True)
+                with open(f"{body_path}.tmp", "wb") as body_file:
+                    body_file.write(compressed)
+                os.replace(f"{body_path}.tmp", body_path)
+                self.total_bytes += len(compressed)
+
+            self._accessed.pop(url, None)
+            self._write_accessed()
+            previous = self._connection.execute(
+                "SELECT digest FROM responses WHERE url = ?", (url,)
+            ).fetchone()
+            self._connection.execute(
+                """
+                INSERT INTO responses (url, digest, size, etag, last_modified, fetched_at, accessed_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(url) DO UPDATE SET
+                    digest = excluded.digest,
+                    size = excluded.size,
+                    etag = excluded.etag,
+                    last_modified = excluded.last_modified,
+                    fetched_at = excluded.fetched_at,
+                    accessed_at = excluded.accessed_at
+                """,
+                (
+                    url,
+                    digest,
+                    os.path.getsize(body_path),
+                    headers.get("ETag"),
+                    headers.get("Last-Modified"),
+                    now,
+                    now,
+                ),
+            )
+            self._connection.commit()
+            if previous and previous[0] != digest:
+                self._remove_orphaned_body(previous[0])
+
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def touch(self, url: str) -> None:
+        """Mark a response as freshly fetched after a 304 Not Modified"""
+        now = time.time()
+        with self._lock:
+            self._accessed.pop(url, None)
+            self._write_accessed()
+            self._connection.execute(
+                "UPDATE responses SET fetched_at = ?, accessed_at = ? WHERE url = ?",
+                (now, now, url),
+            )
+            self._connection.commit()
+
+    def evict(self) -> None:
+        """Drop least recently used entries until the bodies fit in 90% of max_bytes"""
+        target = self.max_bytes * 0.9
+        evicted = 0
+        with self._lock:
+            self._write_accessed()
+            rows = self._connection.execute(
+                "SELECT url, digest FROM responses ORDER BY accessed_at"
+            ).fetchall()
+            for url, digest in rows:
+                if self.total_bytes <= target:
+                    break
+                self._connection.execute("DELETE FROM responses WHERE url = ?", (url,))
+                self._remove_orphaned_body(digest)
+                evicted += 1
+            self._connection.commit()
+        self.logger.debug("Evicted %s cached responses", evicted)
+
+    def flush(self) -> None:
+        """Write the access times of recent cache hits to the index"""
+        with self._lock:
+            self._write_accessed()
+            self._connection.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._write_accessed()
+            self._connection.commit()
+            self._connection.close()
+
+    def _write_accessed(self) -> None:
+        """Write pending access times without committing; the caller holds the lock"""
+        if not self._accessed:
+            return
+        self._connection.executemany(
+            "UPDATE responses SET accessed_at = ? WHERE url = ?",
+            [(accessed_at, url) for url, accessed_at in self._accessed.items()],
+        )
+        self._accessed.clear()
+
+    def _delete(self, url: str) -> None:
+        with self._lock:
+            self._accessed.pop(url, None)
+            row = self._connection.execute(
+                "SELECT digest FROM responses WHERE url = ?", (url,)
+            ).fetchone()
+            self._connection.execute("DELETE FROM responses WHERE url = ?", (url,))
+            self._connection.commit()
+            if row:
+                self._remove_orphaned_body(row[0])
+
+    def _remove_orphaned_body(self, digest: str) -> None:
+        """Delete a body file once no URL refers to it; the caller holds the lock"""
+        in_use = self._connection.execute(
+            "SELECT 1 FROM responses WHERE digest = ? LIMIT 1", (digest,)
+        ).fetchone()
+        if in_use:
+            return
+        body_path = self._body_path(digest)
+        try:
+            self.total_bytes -= os.path.getsize(body_path)
+            os.remove(body_path)
+        except OSError:
+            pass
+
+    def _body_path(self, digest: str) -> str:
+        return os.path.join(self.body_directory, digest[:2], f"{digest}.zz")
@@ -0,0 +1,218 @@
+""" This module is responsible for keeping copies of listing pages for debugging and replay. """
+import argparse
+import atexit
+import gzip
+import os
+import queue
+import random
+import re
+import threading
+import time
+from collections import deque
+from dwellist.logger import DwellistLogger
+from dwellist.metrics import metrics
+
+
+class DebugCapture:
+    """
+    Opt-in store of listing pages that failed to parse, plus a random sample of the rest
+
+    Pages are handed to a background thread that gzips them into the capture directory, so the
+    scrape only pays for queueing the page. The directory is bounded: once it holds more than
+    max_files pages or max_bytes of them, the oldest captures are removed. Capture is off until
+    a directory is configured, and then costs nothing for pages that are neither failed nor
+    sampled. When the queue is full, pages are dropped rather than slowing the scrape down.
+
+    One instance is shared by the whole process as `capture`.
+    """
+
+    logger = DwellistLogger.get_logger()
+
+    _capture_name = re.compile(r"^\d+_(\w+?)_(-?\d+)\.html\.gz$")
+
+    def __init__(self):
+        self.directory = None
+        self.sample_rate = 0.0
+        self.max_files = 500
+        self.max_bytes = 100 * 1024**2
+        self._queue = None
+        self._writer = None
+        self._writer_pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.directory is not None
+
+    def configure(self, config: dict) -> None:
+        """
+        Set up capture from the "debug_capture_dir", "debug_capture_sample",
+        "debug_capture_max_files" and "debug_capture_max_mb" config keys
+
+        :param config: scraper settings
+        """
+        self.close()
+        directory = config.get("debug_capture_dir")
+        self.directory = os.path.abspath(directory) if directory else None
+        self.sample_rate = config.get("debug_capture_sample", 0.0)
+        self.max_files = config.get("debug_capture_max_files", 500)
+        self.max_bytes = config.get("debug_capture_max_mb", 100) * 1024**2
+
+    def listing(self, content, listing) -> None:
+        """
+        Capture a listing page if it failed to parse, or if it is picked by the sample
+
+        A page counts as failed when the listing id, title or room prices could not be read.
+
+        :param content: raw HTML (bytes or str) or Soup object of the listing page
+        :param listing: Listing parsed from the page
+        """
+        if not self.enabled:
+            return
+        if listing.id == -1:
+            self.failed(content, listing.id, "id")
+        elif listing.title in (None, "Unknown Title"):
+            self.failed(content, listing.id, "title")
+        elif listing.available and not listing.rooms:
+            self.failed(content, listing.id, "rooms")
+        else:
+            self.sample(content, listing.id)
+
+    def failed(self, content, listing_id: int = -1, reason: str = "error") -> None:
+        """
+        Capture a page that could not be parsed
+
+        :param content: raw HTML (bytes or str) or Soup object of the listing page
+        :param listing_id: id of the listing, -1 when unknown
+        :param reason: what failed, used in the file name
+        """
+        if self.enabled:
+            self._submit(content, listing_id, reason)
+
+    def sample(self, content, listing_id: int = -1) -> None:
+        """
+        Capture a page that parsed fine with probability debug_capture_sample
+
+        :param content: raw HTML (bytes or str) or Soup object of the listing page
+        :param listing_id: id of the listing
+        """
+        if self.enabled and self.sample_rate and random.random() < self.sample_rate:
+            self._submit(content, listing_id, "sample")
+
+    def _submit(self, content, listing_id: int, reason: str) -> None:
+        # Soup objects are only serialised once they are actually being captured
+        if not isinstance(content, bytes):
+            content = str(content).encode("utf-8")
+        self._start_writer()
+        try:
+            self._queue.put_nowait((time.time_ns(), reason, listing_id, content))
+        except queue.Full:
+            metrics.increment("capture.dropped")
+
+    def _start_writer(self) -> None:
+        """Start the writer thread, again in a forked worker process where it does not exist"""
+        if self._writer_pid == os.getpid():
+            return
+        with self._lock:
+            if self._writer_pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=100)
+            self._writer = threading.Thread(
+                target=self._write_captures,
+                args=(self._queue, self.directory),
+                name="debug-capture",
+                daemon=True,
+            )
+            self._writer.start()
+            self._writer_pid = os.getpid()
+
+    def _write_captures(self, capture_queue, directory: str) -> None:
+        os.makedirs(directory, exist_ok=True)
+        captures = deque(self.captures(directory))
+        total_bytes = sum(size for _, size in captures)
+
+        while (item := capture_queue.get()) is not None:
+            timestamp, reason, listing_id, content = item
+            path = os.path.join(directory, f"{timestamp}_{reason}_{listing_id}.html.gz")
+            try:
+                with open(f"{path}.tmp", "wb") as capture_file:
+                    capture_file.write(gzip.compress(content, compresslevel=6))
+                os.replace(f"{path}.tmp", path)
+            except OSError as e:
+                self.logger.error("Failed to write debug capture %s: %s", path, e)
+                continue
+            size = os.path.getsize(path)
+            captures.append((path, size))
+            total_bytes += size
+            metrics.increment(f"capture.{reason}")
+
+            # Rotate out the oldest captures once the directory is over either limit
+            while captures and (len(captures) > self.max_files or total_bytes > self.max_bytes):
+                old_path, old_size = captures.popleft()
+                try:
+                    os.remove(old_path)
+                except FileNotFoundError:
+                    pass
+                total_bytes -= old_size
+
+    @classmethod
+    def captures(cls, directory: str) -> list:
+        """
+        List the captured pages in a directory, oldest first
+
+        :param directory: capture directory
+        :return: list of (path, size in bytes)
+        """
+        if not os.path.isdir(directory):
+            return []
+        captures = []
+        for name in sorted(os.listdir(directory)):
+            if cls._capture_name.match(name):
+                path = os.path.join(directory, name)
+                captures.append((path, os.path.getsize(path)))
+        return captures
+
+    @staticmethod
+    def read(path: str) -> bytes:
+        """Read the page back out of a capture file"""
+        with gzip.open(path, "rb") as capture_file:
+            return capture_file.read()
+
+    def close(self) -> None:
+        """Write out the pages still queued and stop the writer thread"""
+        with self._lock:
+            if self._writer is not None and self._writer_pid == os.getpid():
+                self._queue.put(None)
+                self._writer.join()
+            self._queue = None
+            self._writer = None
+            self._writer_pid = None
+
+
+capture = DebugCapture()
+atexit.register(capture.close)
+
+
+def main():
+    """Replay captured pages through the listing parser"""
+    from dwellist.listing import Listing
+    from dwellist.scraper import SpareRoomScraper
+
+    arg_parser = argparse.ArgumentParser(description=main.__doc__)
+    arg_parser.add_argument("directory", help="capture directory")
+    arg_parser.add_argument("--reason", help="only replay captures of this kind, e.g. rooms")
+    args = arg_parser.parse_args()
+
+    for path, _ in DebugCapture.captures(args.directory):
+        reason = DebugCapture._capture_name.match(os.path.basename(path)).group(1)
+        if args.reason and reason != args.reason:
+            continue
+        listing = Listing.from_html(DebugCapture.read(path), SpareRoomScraper.domain)
+        print(
+            f"{os.path.basename(path)}: id={listing.id} title={listing.title!r} "
+            f"rooms={listing.rooms}"
+        )
+
+
+if __name__ == "__main__":
+    main()
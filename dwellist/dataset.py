@@ -0,0 +1,233 @@
+""" This module is responsible for writing listings to a partitioned Parquet dataset for analysis. """
+import argparse
+import datetime
+import os
+import uuid
+from collections import defaultdict
+import pandas as pd
+from pandas import DataFrame
+from dwellist.logger import DwellistLogger
+from dwellist.preprocessor import DataProcessor
+from dwellist.storage import ListingStore
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+
+    PARQUET_AVAILABLE = True
+except ImportError:
+    PARQUET_AVAILABLE = False
+
+
+UNKNOWN_PARTITION = "unknown"
+
+
+def _scrape_date(date_scraped) -> datetime.date:
+    """Parse the dd-mm-YYYY date a listing was scraped, or None if it is missing or malformed"""
+    try:
+        return datetime.datetime.strptime(date_scraped, "%d-%m-%Y").date()
+    except (TypeError, ValueError):
+        return None
+
+
+class ListingDataset:
+    """
+    Append-only Parquet dataset of listings
+
+    Files are laid out in hive partitions, scrape_date=YYYY-MM-DD/search=<search key>, and every
+    append writes new files rather than rewriting old ones. Prices, coordinates and dates have
+    typed columns, rooms and images are nested lists and features a string map, so readers can
+    load only the columns and partitions they need.
+    """
+
+    logger = DwellistLogger.get_logger()
+
+    def __init__(self, directory: str, compression: str = "zstd"):
+        """
+        :param directory: root directory of the dataset, created if needed
+        :param compression: Parquet compression codec
+        """
+        if not PARQUET_AVAILABLE:
+            raise ImportError("The Parquet dataset needs pyarrow: pip install pyarrow")
+        self.directory = directory
+        self.compression = compression
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def schema():
+        """Arrow schema of the data files; the partition columns come from the directory names"""
+        return pa.schema(
+            [
+                ("id", pa.int64()),
+                ("available", pa.bool_()),
+                ("url", pa.string()),
+                ("title", pa.string()),
+                ("description", pa.string()),
+                ("type", pa.string()),
+                ("area", pa.string()),
+                ("postcode", pa.string()),
+                ("nearest_station", pa.string()),
+                ("room_count", pa.int16()),
+                ("min_price_pcm", pa.int32()),
+                ("max_price_pcm", pa.int32()),
+                (
+                    "rooms",
+                    pa.list_(
+                        pa.struct([("price_pcm", pa.int32()), ("type", pa.string())])
+                    ),
+                ),
+                ("latitude", pa.float64()),
+                ("longitude", pa.float64()),
+                ("main_image", pa.string()),
+                ("images", pa.list_(pa.string())),
+                ("features", pa.map_(pa.string(), pa.string())),
+                ("date_scraped", pa.date32()),
+            ]
+        )
+
+    @staticmethod
+    def partitioning():
+        return ds.partitioning(
+            pa.schema([("scrape_date", pa.string()), ("search", pa.string())]),
+            flavor="hive",
+        )
+
+    def append(self, listings: list, search_keys: dict = None) -> int:
+        """
+        Write listings as new files in their scrape date and search partitions
+
+        :param listings: list of Listing objects
+        :param search_keys: listing id -> key of the search that found it; others go to "unknown"
+        :return: number of listings written
+        """
+        search_keys = search_keys or {}
+        partitions = defaultdict(list)
+        for listing in listings:
+            scrape_date = _scrape_date(listing.date_scraped)
+            partition = (
+                scrape_date.isoformat() if scrape_date else UNKNOWN_PARTITION,
+                search_keys.get(listing.id) or UNKNOWN_PARTITION,
+            )
+            partitions[partition].append(listing)
+
+        for (scrape_date, search), partition_listings in partitions.items():
+            partition_dir = os.path.join(
+                self.directory, f"scrape_date={scrape_date}", f"search={search}"
+            )
+            os.makedirs(partition_dir, exist_ok=True)
+            path = os.path.join(partition_dir, f"part-{uuid.uuid4().hex}.parquet")
+            table = self.to_table(partition_listings)
+            # Write under a temporary name so readers never see a half written file
+            pq.write_table(table, f"{path}.tmp", compression=self.compression)
+            os.replace(f"{path}.tmp", path)
+        self.logger.debug(
+            "Appended %s listings in %s partitions", len(listings), len(partitions)
+        )
+        return len(listings)
+
+    @classmethod
+    def to_table(cls, listings: list):
+        """
+        Build an Arrow table of listings in a single columnar pass
+
+        :param listings: list of Listing objects
+        :return: pyarrow Table with the dataset schema
+        """
+        records = [listing.to_record() for listing in listings]
+        processor = DataProcessor({})
+        rooms = processor.rooms(records)
+        summary = processor.room_summary(rooms, len(records))
+        room_lists = [[] for _ in records]
+        for listing_no, price_pcm, room_type in zip(
+            rooms["listing"], rooms["price_pcm"], rooms["type"]
+        ):
+            room_lists[listing_no].append(
+                {
+                    "price_pcm": None if price_pcm is pd.NA else int(price_pcm),
+                    "type": None if room_type is pd.NA else room_type,
+                }
+            )
+
+        columns = defaultdict(list)
+        columns["rooms"] = room_lists
+        columns["room_count"] = summary["room_count"].tolist()
+        for column in ("min_price_pcm", "max_price_pcm"):
+            columns[column] = [
+                None if price is pd.NA else int(price) for price in summary[column]
+            ]
+        for listing in listings:
+            for field in (
+                "id",
+                "available",
+                "url",
+                "title",
+                "description",
+                "type",
+                "area",
+                "postcode",
+                "nearest_station",
+                "latitude",
+                "longitude",
+                "main_image",
+                "images",
+            ):
+                columns[field].append(getattr(listing, field))
+            columns["features"].append(
+                [(key, str(value)) for key, value in listing.features.items()]
+            )
+            columns["date_scraped"].append(_scrape_date(listing.date_scraped))
+        schema = cls.schema()
+        return pa.table(
+            {field.name: columns[field.name] for field in schema}, schema=schema
+        )
+
+    def read(
+        self, columns: list = None, scrape_dates: list = None, searches: list = None
+    ) -> DataFrame:
+        """
+        Load listings, reading only the requested columns and partitions
+
+        :param columns: columns to load, defaults to every column including the partition columns
+        :param scrape_dates: dates (datetime.date or YYYY-MM-DD) to load, defaults to all
+        :param searches: search keys to load, defaults to all
+        :return: DataFrame of listings
+        """
+        schema = self.schema()
+        for partition_field in self.partitioning().schema:
+            schema = schema.append(partition_field)
+        dataset = ds.dataset(
+            self.directory,
+            schema=schema,
+            format="parquet",
+            partitioning=self.partitioning(),
+        )
+        expression = None
+        if scrape_dates:
+            expression = ds.field("scrape_date").isin([str(date) for date in scrape_dates])
+        if searches:
+            search_expression = ds.field("search").isin(list(searches))
+            expression = (
+                search_expression if expression is None else expression & search_expression
+            )
+        return dataset.to_table(columns=columns, filter=expression).to_pandas()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description="Write every listing in a SQLite listing store to a Parquet dataset"
+    )
+    arg_parser.add_argument("database_path", help="SQLite listing store")
+    arg_parser.add_argument("dataset_dir", help="directory of the Parquet dataset")
+    args = arg_parser.parse_args()
+
+    store = ListingStore(args.database_path)
+    listings = store.get_listings()
+    # Partition by search key, as the pipeline does, not by the search's display name
+    search_keys = store.get_first_search_keys()
+    store.close()
+    ListingDataset(args.dataset_dir).append(listings, search_keys)
+
+
+if __name__ == "__main__":
+    main()
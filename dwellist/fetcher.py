@@ -0,0 +1,272 @@
+""" This module is responsible for fetching pages over a shared, rate limited async HTTP client. """
+import asyncio
+import random
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlsplit
+import httpx
+from dwellist.cache import ResponseCache
+from dwellist.logger import DwellistLogger
+from dwellist.metrics import metrics
+
+try:
+    import h2  # noqa: F401
+
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+class FetchResult:
+    """The outcome of fetching a single URL; failures are recorded rather than raised"""
+
+    __slots__ = (
+        "url", "status_code", "content", "headers", "error", "attempts", "from_cache"
+    )
+
+    def __init__(
+        self,
+        url,
+        status_code=None,
+        content=None,
+        headers=None,
+        error=None,
+        attempts=0,
+        from_cache=False,
+    ):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+        self.error = error
+        self.attempts = attempts
+        self.from_cache = from_cache
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None and self.status_code == 200
+
+    def __repr__(self):
+        return f"FetchResult({self.url!r}, status_code={self.status_code}, error={self.error!r})"
+
+
+class HostRateLimiter:
+    """Spaces out requests to each host so no host sees more than `rate` requests per second"""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate else 0
+        self._next_slot = defaultdict(float)
+        self._locks = defaultdict(asyncio.Lock)
+
+    async def wait(self, host: str) -> None:
+        if not self.interval:
+            return
+        async with self._locks[host]:
+            loop = asyncio.get_running_loop()
+            now = loop.time()
+            delay = self._next_slot[host] - now
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._next_slot[host] = max(now, self._next_slot[host]) + self.interval
+
+
+class BlockingHostRateLimiter:
+    """HostRateLimiter for worker threads, spacing out requests to each host across threads"""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate else 0
+        self._next_slot = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def wait(self, host: str) -> None:
+        if not self.interval:
+            return
+        # Reserve the next slot under the lock, then sleep until it outside of it
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot[host])
+            self._next_slot[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class AsyncFetcher:
+    """
+    Shared async HTTP client for SpareRoomScraper
+
+    Concurrency is bounded by a semaphore and the connection pool limits, requests to each host
+    are rate limited, and 429/5xx responses and transport errors are retried with jittered
+    exponential backoff. Any other request error is returned in the FetchResult rather than
+    raised. The client is opened on the first `async with` and closed when the
+    outermost one exits, so nested users share one connection pool.
+
+    When a ResponseCache is configured, fresh cached pages are served from disk and stale ones
+    are revalidated with If-None-Match/If-Modified-Since.
+    """
+
+    logger = DwellistLogger.get_logger()
+
+    RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+    def __init__(self, config: dict, cache: ResponseCache = None, transport=None):
+        """
+        :param config: scraper settings
+        :param cache: ResponseCache, created from the config if omitted
+        :param transport: httpx transport to send requests through, e.g. httpx.MockTransport
+        """
+        self.max_concurrency = config.get("max_concurrency", 10)
+        self.max_connections = config.get("max_connections", self.max_concurrency)
+        self.max_retries = config.get("max_retries", 3)
+        self.backoff_base = config.get("backoff_base", 0.5)
+        self.backoff_max = config.get("backoff_max", 30)
+        self.timeout = config.get("request_timeout", 20)
+        self.http2 = config.get("http2", True) and HTTP2_AVAILABLE
+        self.requests_per_second = config.get("requests_per_second", 5)
+        self.cache = cache if cache is not None else ResponseCache.from_config(config)
+        self.transport = transport
+
+        self.client = None
+        self.rate_limiter = None
+        self._semaphore = None
+        self._users = 0
+
+    async def __aenter__(self):
+        if self._users == 0:
+            # Locks and timers belong to the running event loop, so they are created per session
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self.rate_limiter = HostRateLimiter(self.requests_per_second)
+            self.client = httpx.AsyncClient(
+                http2=self.http2,
+                timeout=self.timeout,
+                transport=self.transport,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                ),
+            )
+        self._users += 1
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._users -= 1
+        if self._users == 0:
+            await self.client.aclose()
+            self.client = None
+            if self.cache is not None:
+                await asyncio.to_thread(self.cache.flush)
+
+    async def fetch(
+        self,
+        url: str,
+        page_type: str = None,
+        follow_redirects: bool = False,
+        revalidate: bool = False,
+    ) -> FetchResult:
+        """
+        Fetch a URL, retrying transient failures
+
+        :param url: URL to fetch
+        :param page_type: "search" or "detail", selects the cache TTL
+        :param follow_redirects: follow redirects and report the final URL as the result's url;
+            such requests bypass the cache, as where a URL redirects to can change
+        :param revalidate: ask the server even if the cached copy is still fresh, for pages
+            known to have changed; the cached copy's validators are still sent
+        :return: FetchResult with the response body or the error that stopped the request
+        """
+        use_cache = self.cache is not None and not follow_redirects
+        cached = None
+        if use_cache:
+            cached = await asyncio.to_thread(self.cache.get, url, page_type)
+            if cached is not None and cached.fresh and not revalidate:
+                metrics.increment("cache.hit")
+                return FetchResult(url, 200, cached.content, from_cache=True)
+            metrics.increment("cache.miss" if cached is None else "cache.stale")
+        request_headers = cached.validators() if cached is not None else {}
+
+        host = urlsplit(url).netloc
+        result = FetchResult(url)
+        start = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            result.attempts = attempt + 1
+            retry_after = None
+            async with self._semaphore:
+                await self.rate_limiter.wait(host)
+                metrics.increment("fetch.requests")
+                try:
+                    response = await self.client.get(
+                        url, headers=request_headers, follow_redirects=follow_redirects
+                    )
+                except httpx.TransportError as e:
+                    result.error = f"{type(e).__name__}: {e}"
+                except httpx.RequestError as e:
+                    # Decoding errors and redirect loops will not go away on a retry
+                    result.error = f"{type(e).__name__}: {e}"
+                    break
+                else:
+                    result.status_code = response.status_code
+                    result.headers = response.headers
+                    metrics.increment("fetch.bytes", len(response.content))
+                    if response.status_code in self.RETRY_STATUS_CODES:
+                        result.error = f"HTTP {response.status_code}"
+                        retry_after = self._retry_after(response)
+                    else:
+                        metrics.observe(
+                            f"fetch.{page_type or 'page'}", time.perf_counter() - start
+                        )
+                        if follow_redirects:
+                            result.url = str(response.url)
+                        return await self._complete(result, response, cached, use_cache)
+
+            if attempt < self.max_retries:
+                metrics.increment("fetch.retries")
+                delay = retry_after if retry_after is not None else self._backoff(attempt)
+                self.logger.debug(
+                    "Retrying %s in %.2fs after %s", url, delay, result.error
+                )
+                await asyncio.sleep(delay)
+
+        metrics.increment("fetch.errors")
+        self.logger.warning(
+            "Giving up on %s after %s attempts: %s", url, result.attempts, result.error
+        )
+        return result
+
+    async def _complete(self, result, response, cached, use_cache=True) -> FetchResult:
+        """Fill in a result from a final response, updating the cache"""
+        if response.status_code == 304 and cached is not None:
+            metrics.increment("cache.revalidated")
+            await asyncio.to_thread(self.cache.touch, result.url)
+            result.status_code = 200
+            result.content = cached.content
+            result.error = None
+            result.from_cache = True
+            return result
+
+        result.content = response.content
+        result.error = None if response.is_success else f"HTTP {response.status_code}"
+        if use_cache and self.cache is not None and response.status_code == 200:
+            await asyncio.to_thread(
+                self.cache.put, result.url, result.content, response.headers
+            )
+        return result
+
+    async def fetch_all(self, urls: list, page_type: str = None) -> list:
+        """
+        Fetch every URL concurrently within the fetcher's limits
+
+        :param urls: list of URLs
+        :param page_type: "search" or "detail", selects the cache TTL
+        :return: list of FetchResult, in the same order as urls
+        """
+        return await asyncio.gather(*(self.fetch(url, page_type) for url in urls))
+
+    def _backoff(self, attempt: int) -> float:
+        """Full jitter exponential backoff"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt))
+
+    def _retry_after(self, response) -> float:
+        retry_after = response.headers.get("Retry-After")
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), self.backoff_max)
+        return None
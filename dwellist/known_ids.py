@@ -0,0 +1,209 @@
+""" This module is responsible for answering "have we already stored this listing?" in constant time. """
+import hashlib
+import math
+import os
+import struct
+from dwellist.logger import DwellistLogger
+
+
+def _as_listing_id(listing_id) -> int:
+    """Normalise a listing id from a page, csv or database to an int, or None if it is not one"""
+    try:
+        return int(listing_id)
+    except (TypeError, ValueError):
+        return None
+
+
+class KnownListingIds:
+    """Hash set of stored listing ids, loaded once per run"""
+
+    def __init__(self, listing_ids=()):
+        self._ids = set()
+        self.update(listing_ids)
+
+    @classmethod
+    def from_store(cls, store):
+        """
+        :param store: ListingStore
+        :return: KnownListingIds of every listing in the store
+        """
+        return cls(store.iter_ids())
+
+    @classmethod
+    def from_dataframe(cls, listings):
+        """
+        :param listings: DataFrame of listings, may be None or empty
+        :return: KnownListingIds of every listing in the DataFrame
+        """
+        if listings is None or listings.empty:
+            return cls()
+        return cls(listings["id"].dropna().tolist())
+
+    def __contains__(self, listing_id) -> bool:
+        return _as_listing_id(listing_id) in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, listing_id) -> None:
+        listing_id = _as_listing_id(listing_id)
+        if listing_id is not None:
+            self._ids.add(listing_id)
+
+    def update(self, listing_ids) -> None:
+        for listing_id in listing_ids:
+            self.add(listing_id)
+
+    def stored(self, listing_ids) -> set:
+        """
+        :param listing_ids: listing ids, e.g. the ids on a search results page
+        :return: set of the ids that are stored
+        """
+        return {listing_id for listing_id in listing_ids if listing_id in self}
+
+
+class BloomFilter:
+    """Fixed size Bloom filter over integer listing ids using double hashing"""
+
+    HEADER = struct.Struct("<QQQ")
+
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        capacity = max(capacity, 1)
+        self.bit_count = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.bit_count / capacity * math.log(2)))
+        self.bits = bytearray((self.bit_count + 7) // 8)
+        self.count = 0
+
+    def _positions(self, listing_id: int):
+        digest = hashlib.blake2b(listing_id.to_bytes(8, "little", signed=True), digest_size=16)
+        first, second = struct.unpack("<QQ", digest.digest())
+        for i in range(self.hash_count):
+            yield (first + i * second) % self.bit_count
+
+    def add(self, listing_id: int) -> None:
+        for position in self._positions(listing_id):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, listing_id: int) -> bool:
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(listing_id)
+        )
+
+    def save(self, path: str) -> None:
+        with open(f"{path}.tmp", "wb") as bloom_file:
+            bloom_file.write(self.HEADER.pack(self.bit_count, self.hash_count, self.count))
+            bloom_file.write(self.bits)
+        os.replace(f"{path}.tmp", path)
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path, "rb") as bloom_file:
+            bit_count, hash_count, count = cls.HEADER.unpack(bloom_file.read(cls.HEADER.size))
+            bits = bytearray(bloom_file.read())
+        bloom = cls.__new__(cls)
+        bloom.bit_count, bloom.hash_count, bloom.count, bloom.bits = (
+            bit_count,
+            hash_count,
+            count,
+            bits,
+        )
+        return bloom
+
+
+class BloomKnownListingIds:
+    """
+    Known listing ids backed by a Bloom filter persisted next to the listing store
+
+    Ids the filter has never seen are rejected without touching the database. Possible matches
+    are confirmed with an indexed lookup in the store, so false positives never hide a new listing
+    and the full id history is never loaded into memory.
+    """
+
+    logger = DwellistLogger.get_logger()
+
+    def __init__(self, bloom: BloomFilter, store=None, path: str = None):
+        self.bloom = bloom
+        self.store = store
+        self.path = path
+
+    @classmethod
+    def open(cls, path: str, store, error_rate: float = 0.001):
+        """
+        Load the persisted filter, rebuilding it from the store when missing or out of date
+
+        :param path: path of the persisted Bloom filter
+        :param store: ListingStore the filter summarises
+        :param error_rate: target false positive rate when the filter is rebuilt
+        :return: BloomKnownListingIds
+        """
+        stored = len(store)
+        bloom = BloomFilter.load(path) if os.path.exists(path) else None
+        if bloom is None or bloom.count != stored:
+            # Leave room for the listings this and later runs add before the next rebuild
+            bloom = BloomFilter(max(stored * 2, 100_000), error_rate)
+            for listing_id in store.iter_ids():
+                bloom.add(listing_id)
+            bloom.save(path)
+            cls.logger.debug("Rebuilt Bloom filter of %s listing ids", stored)
+        return cls(bloom, store, path)
+
+    def __contains__(self, listing_id) -> bool:
+        listing_id = _as_listing_id(listing_id)
+        if listing_id is None or listing_id not in self.bloom:
+            return False
+        return self.store is None or self.store.contains(listing_id)
+
+    def __len__(self):
+        return self.bloom.count
+
+    def stored(self, listing_ids) -> set:
+        """
+        Check a batch of ids, confirming every Bloom filter match in one database query
+
+        :param listing_ids: listing ids, e.g. the ids on a search results page
+        :return: set of the ids that are stored
+        """
+        matches = [
+            listing_id
+            for listing_id in map(_as_listing_id, listing_ids)
+            if listing_id is not None and listing_id in self.bloom
+        ]
+        if self.store is None or not matches:
+            return set(matches)
+        return self.store.get_existing_ids(matches)
+
+    def add(self, listing_id) -> None:
+        listing_id = _as_listing_id(listing_id)
+        if listing_id is not None and listing_id not in self.bloom:
+            self.bloom.add(listing_id)
+
+    def update(self, listing_ids) -> None:
+        for listing_id in listing_ids:
+            self.add(listing_id)
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        if self.store is not None:
+            # add skips new ids the filter already matches by chance, so the count of ids
+            # summarised is taken from the store rather than from the adds
+            self.bloom.count = len(self.store)
+        self.bloom.save(self.path)
+
+
+def load_known_ids(config: dict, store=None, listings=None):
+    """
+    Load the known listing id index selected by the "known_ids" config value
+
+    :param config: search config
+    :param store: ListingStore, if the SQLite store is in use
+    :param listings: DataFrame of existing listings, if the csv is in use
+    :return: KnownListingIds, or BloomKnownListingIds for the "bloom" mode with a store
+    """
+    if store is not None and config.get("known_ids") == "bloom":
+        return BloomKnownListingIds.open(f"{store.path}.bloom", store)
+    if store is not None:
+        return KnownListingIds.from_store(store)
+    return KnownListingIds.from_dataframe(listings)
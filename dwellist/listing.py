@@ -1,7 +1,12 @@
 import datetime
+import math
+import re
 from dwellist.logger import DwellistLogger
 import traceback
 from bs4 import BeautifulSoup as Soup
+from pandas import DataFrame
+from dwellist.parser import parse_listing
+from dwellist.schema import feature_key, image_column, room_columns
 
 
 class Listing:
@@ -20,14 +25,40 @@ class Listing:
         images
         room prices
         date_scraped
+
+    Every listing has the same fixed set of slots. Rooms are a list of (price, type) pairs,
+    images a list of links and the long tail of feature-list entries a separate dictionary.
+    `to_dict` flattens a listing into the original csv columns (room_1_price, image_1, ...).
     """
 
     logger = DwellistLogger.get_logger()
 
+    __slots__ = (
+        "id",
+        "available",
+        "url",
+        "title",
+        "description",
+        "type",
+        "area",
+        "postcode",
+        "nearest_station",
+        "rooms",
+        "latitude",
+        "longitude",
+        "main_image",
+        "images",
+        "features",
+        "date_scraped",
+    )
+
+    _room_column = re.compile(r"room_(\d+)_(price|type)$")
+    _image_column = re.compile(r"image_(\d+)$")
+
     def __init__(self, listing, domain):
         self.id = -1
         try:
-            self.id = listing.prettify().split("flatshare_id=")[1].split("&")[0]
+            self.id = int(listing.prettify().split("flatshare_id=")[1].split("&")[0])
         except (KeyError, ValueError, IndexError) as e:
             self.logger.error("Error parsing room id: %s", e)
 
@@ -35,7 +66,7 @@ class Listing:
         if "Sorry, this room is no longer available" in listing.prettify():
             self.available = False
 
-        self.url = domain + self.id
+        self.url = domain + str(self.id)
         self.title = "Unknown Title"
         try:
             title = listing.find("div", {"id": "listing_heading"})
@@ -48,32 +79,177 @@ class Listing:
         )
 
         key_features = self._get_key_features(listing)
-        [setattr(self, feature, key_features[feature]) for feature in key_features]
-
-        room_prices_per_month = self._get_room_prices_pm(listing)
-        for i, room_price_info in enumerate(room_prices_per_month):
-            price, type = (
-                room_price_info["price"],
-                room_price_info["type"],
-            )
-            setattr(self, f"room_{i+1}_price", price)
-            setattr(self, f"room_{i+1}_type", type)
+        self.type = key_features["type"]
+        self.area = key_features["area"]
+        self.postcode = key_features["postcode"]
+        self.nearest_station = key_features["nearest_station"]
 
-        self.location_coords = self._get_location_coords(listing)
-        self.latitude = self.location_coords[0] if self.location_coords else None
-        self.longitude = self.location_coords[1] if self.location_coords else None
+        self.rooms = [
+            (room["price"], room["type"]) for room in self._get_room_prices_pm(listing)
+        ]
 
-        features = self._get_features(listing)
+        location_coords = self._get_location_coords(listing)
+        self.latitude = location_coords[0] if location_coords else None
+        self.longitude = location_coords[1] if location_coords else None
 
-        for header in features:
-            value = features[header]
-            setattr(self, header, value)
+        self.features = self._get_features(listing)
+        self.main_image, self.images = self._get_images(listing)
 
         # Todays date
         self.date_scraped = datetime.datetime.now().strftime("%d-%m-%Y")
 
+    @classmethod
+    def from_html(cls, content, domain):
+        """
+        Build a Listing from the raw HTML of a listing page using the lxml parser
+
+        :param content: raw HTML of the listing page (bytes or str)
+        :param domain: listing URL prefix the listing id is appended to
+        :return: Listing object
+        """
+        return cls.from_record(parse_listing(content, domain))
+
+    @classmethod
+    def from_record(cls, record):
+        """
+        Build a Listing from a record produced by the lxml ListingParser or `to_record`
+
+        :param record: dictionary with one entry per slot; date_scraped defaults to today
+        :return: Listing object
+        """
+        listing = cls.__new__(cls)
+        for field in cls.__slots__:
+            setattr(listing, field, record.get(field))
+        listing.rooms = [tuple(room) for room in listing.rooms or ()]
+        listing.images = list(listing.images or ())
+        listing.features = dict(listing.features or {})
+        if not listing.date_scraped:
+            listing.date_scraped = datetime.datetime.now().strftime("%d-%m-%Y")
+        return listing
+
+    @classmethod
+    def from_dict(cls, row):
+        """
+        Build a Listing from a flat row in the csv layout produced by `to_dict`
+
+        :param row: dictionary of csv columns; missing values may be None or NaN
+        :return: Listing object
+        """
+        record = {"rooms": [], "images": [], "features": {}}
+        rooms = {}
+        images = {}
+        for column, value in row.items():
+            if value is None or (isinstance(value, float) and math.isnan(value)):
+                continue
+            room_match = cls._room_column.match(column)
+            image_match = cls._image_column.match(column)
+            if room_match:
+                rooms.setdefault(int(room_match.group(1)), {})[room_match.group(2)] = value
+            elif image_match:
+                images[int(image_match.group(1))] = value
+            elif column == "location_coords":
+                continue
+            elif column in cls.__slots__ and column not in ("rooms", "images", "features"):
+                record[column] = value
+            else:
+                record["features"][column] = value
+
+        # A feature-list "Available" entry shares its column with the availability flag
+        if not isinstance(record.get("available", True), bool):
+            record["features"]["available"] = record.pop("available")
+            record["available"] = True
+        record["id"] = int(record["id"])
+        record["rooms"] = [
+            (rooms[i].get("price"), rooms[i].get("type")) for i in sorted(rooms)
+        ]
+        record["images"] = [images[i] for i in sorted(images)]
+        return cls.from_record(record)
+
+    @staticmethod
+    def price_pcm(price) -> int:
+        """Normalise a room price from the parser ("1,050", 974 or "974") to whole pounds per month"""
+        if price is None or (isinstance(price, float) and math.isnan(price)):
+            return None
+        try:
+            return int(float(str(price).replace(",", "")))
+        except ValueError:
+            return None
+
+    @property
+    def location_coords(self):
+        if self.latitude is None or self.longitude is None:
+            return None
+        return (self.latitude, self.longitude)
+
+    def to_record(self) -> dict:
+        """
+        Get the listing as a nested dictionary with one entry per slot
+
+        :return: dictionary of listing fields
+        """
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    def to_dict(self) -> dict:
+        """
+        Get the listing flattened into the csv column layout
+
+        :return: dictionary of csv columns
+        """
+        row = {
+            "id": self.id,
+            "available": self.available,
+            "url": self.url,
+            "title": self.title,
+            "description": self.description,
+            "type": self.type,
+            "area": self.area,
+            "postcode": self.postcode,
+            "nearest_station": self.nearest_station,
+        }
+        for room_no, (price, room_type) in enumerate(self.rooms, 1):
+            price_column, type_column = room_columns(room_no)
+            row[price_column] = price
+            row[type_column] = room_type
+        row["location_coords"] = self.location_coords
+        row["latitude"] = self.latitude
+        row["longitude"] = self.longitude
+        row.update(self.features)
+        if self.main_image is not None:
+            row["main_image"] = self.main_image
+            for image_no, link in enumerate(self.images, 1):
+                row[image_column(image_no)] = link
+        row["date_scraped"] = self.date_scraped
+        return row
+
+    @staticmethod
+    def to_columns(listings: list) -> dict:
+        """
+        Flatten a batch of listings into csv columns in a single pass
+
+        :param listings: list of Listing objects
+        :return: dictionary of column name to list of values, one per listing
+        """
+        columns = {}
+        for row_no, listing in enumerate(listings):
+            for column, value in listing.to_dict().items():
+                values = columns.get(column)
+                if values is None:
+                    values = columns[column] = [None] * len(listings)
+                values[row_no] = value
+        return columns
+
+    @classmethod
+    def to_dataframe(cls, listings: list) -> DataFrame:
+        """
+        Build a DataFrame in the csv column layout from a batch of listings
+
+        :param listings: list of Listing objects
+        :return: DataFrame of listings
+        """
+        return DataFrame(cls.to_columns(listings))
+
     def __str__(self):
-        return str(self.__dict__)
+        return str(self.to_dict())
 
     def _get_room_prices_pm(self, listing: Soup) -> list:
         room_prices = []
@@ -107,9 +283,6 @@ class Listing:
                 type = li.find("small").text.strip().replace("(", "").replace(")", "")
                 room_prices.append({"price": price, "type": type})
         except Exception as e:
-            # Save room soup to file for debugging
-            with open(f"room_{self.id}.html", "w", encoding="utf-8") as file:
-                file.write(str(listing))
             self.logger.error("Error parsing room price: %s", e)
             self.logger.info(self.url)
         return room_prices
@@ -139,31 +312,27 @@ class Listing:
         features = {}
         for feature_list in feature_lists:
             for dt, dd in zip(feature_list.find_all("dt"), feature_list.find_all("dd")):
-                key = dt.text.replace("\n", "").replace("#", "").strip().lower()
-                # Replace spaces, dashes, slashes, parentheses, quotes, colons, periods, commas, and ampersands with underscores
-                key = key.translate(str.maketrans(" -/()':.,&?", "___________"))
-                # Replace multiple underscores with a single underscore
-                key = "_".join(key.split("_")).strip("_")
-                features[key] = dd.text.strip()
+                features[feature_key(dt.text)] = dd.text.strip()
+
+        # features["postcode"].replace("Area info", "")
+        return features
 
+    def _get_images(self, room_soup):
+        """Get the main image and the links of every gallery thumbnail"""
+        images = []
         main_image = self._get_main_image(room_soup)
         if main_image is not None:
-            features["main_image"] = main_image
-
-            # roo
-            images = room_soup.find(
+            thumbnails = room_soup.find(
                 "div",
                 class_="photo-gallery__thumbnails photo-gallery__thumbnails--has-photos",
             )
-            for image_no, image_link in enumerate(images.find_all("a")):
+            for image_link in thumbnails.find_all("a"):
                 # Get image from img src
                 link = image_link["href"]
                 # Ensure image link is prefixed with https:
                 link = link if link.startswith("https:") else f"https:{link}"
-                features[f"image_{image_no+1}"] = link
-
-        # features["postcode"].replace("Area info", "")
-        return features
+                images.append(link)
+        return main_image, images
 
     def _get_main_image(self, room_soup):
         try:
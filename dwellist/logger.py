@@ -1,9 +1,117 @@
+import atexit
+import json
 import logging
+import logging.handlers
+import os
+import queue
+import threading
 import time
 
 
+class JsonFormatter(logging.Formatter):
+    """Format records as one JSON object per line, including any extra fields"""
+
+    # Attributes every LogRecord has; anything else was passed through `extra`
+    RESERVED = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "message": record.getMessage(),
+            "thread": record.threadName,
+        }
+        for key, value in vars(record).items():
+            if key not in self.RESERVED:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Token bucket per message template for records below WARNING
+
+    High-volume per-listing messages ("%s already logged") are let through at `rate` per second
+    with bursts of up to `burst`; the next record let through notes how many were dropped.
+    Warnings and errors always pass. Messages are bucketed by their unformatted template, so
+    calls should pass arguments %-style; at most max_buckets templates are tracked, the least
+    recently logged being forgotten first.
+    """
+
+    def __init__(self, rate: float, burst: int = 100, max_buckets: int = 1024):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.max_buckets = max_buckets
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        key = (record.msg, record.levelno)
+        now = time.monotonic()
+        with self._lock:
+            # Buckets are kept in the order they were last used
+            tokens, last, suppressed = self._buckets.pop(key, (self.burst, now, 0))
+            if len(self._buckets) >= self.max_buckets:
+                del self._buckets[next(iter(self._buckets))]
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now, suppressed + 1)
+                return False
+            self._buckets[key] = (tokens - 1, now, 0)
+        if suppressed:
+            record.suppressed = suppressed
+            record.msg = f"{record.msg} [{suppressed} similar messages suppressed]"
+        return True
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that leaves formatting to the listener thread and never blocks
+
+    Records are queued as they are and formatted by the listener, so the caller only pays for
+    creating the record. When the queue is full the record is dropped and counted. In a forked
+    worker process, where the listener thread does not exist, records go straight to the
+    listener's handlers instead.
+    """
+
+    def __init__(self, log_queue, handlers):
+        super().__init__(log_queue)
+        self.handlers = handlers
+        self.dropped = 0
+        self._pid = os.getpid()
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def emit(self, record):
+        if os.getpid() != self._pid:
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+            return
+        super().emit(record)
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # Wait for room rather than fail if the queue is full when stopping
+        self.queue.put(self._sentinel)
+
+
 class DwellistLogger:
     _logger = None  # Class-level logger instance
+    _listener = None
 
     @staticmethod
     def get_logger():
@@ -12,31 +120,85 @@ class DwellistLogger:
         return DwellistLogger._logger
 
     @staticmethod
-    def setup_logger():
-        """Set up a logger"""
+    def configure(config: dict):
+        """
+        Reconfigure the shared logger from the "log_queue", "log_format" and "log_rate_limit" keys
+
+        :param config: scraper settings
+        :return: logger
+        """
+        return DwellistLogger.setup_logger(
+            use_queue=config.get("log_queue", True),
+            log_format=config.get("log_format", "text"),
+            rate_limit=config.get("log_rate_limit", 20),
+        )
+
+    @staticmethod
+    def setup_logger(use_queue=True, log_format="text", rate_limit=20, queue_size=10000):
+        """
+        Set up a logger
+
+        :param use_queue: hand records to a background listener thread instead of writing inline
+        :param log_format: "text" or "json"
+        :param rate_limit: records per second allowed for each debug/info message, 0 for no limit
+        :param queue_size: most records waiting for the listener before new ones are dropped
+        :return: logger
+        """
         # Create a logger
         logger = logging.getLogger("my_logger")
         logger.setLevel(logging.DEBUG)
+        DwellistLogger._stop_listener()
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+            handler.close()
+        for log_filter in list(logger.filters):
+            logger.removeFilter(log_filter)
+
+        if log_format == "json":
+            formatter = JsonFormatter()
+        else:
+            formatter = logging.Formatter(
+                "[%(asctime)s %(levelname)s]\t%(message)s", datefmt="%H:%M:%S"
+            )
 
         # Create a handler for writing to a file
         log_filename = f'my_log_{time.strftime("%Y_%m_%d")}.log'
-        file_handler = logging.FileHandler(log_filename)
+        file_handler = logging.FileHandler(log_filename, delay=True)
         file_handler.setLevel(logging.DEBUG)
-        formatter = logging.Formatter(
-            "[%(asctime)s %(levelname)s]\t%(message)s", datefmt="%H:%M:%S"
-        )
         file_handler.setFormatter(formatter)
-        logger.addHandler(file_handler)
 
         # Create a handler for printing to the console
         console_handler = logging.StreamHandler()
         console_handler.setLevel(
             logging.INFO
         )  # You can set the desired logging level here
-        console_formatter = logging.Formatter(
-            "[%(asctime)s %(levelname)s]\t%(message)s", datefmt="%H:%M:%S"
-        )
-        console_handler.setFormatter(console_formatter)
-        logger.addHandler(console_handler)
+        console_handler.setFormatter(formatter)
+
+        # Drop floods of repeated per-listing messages before they cost anything more
+        if rate_limit:
+            logger.addFilter(RateLimitFilter(rate_limit))
 
+        handlers = [file_handler, console_handler]
+        if not use_queue:
+            for handler in handlers:
+                logger.addHandler(handler)
+            return logger
+
+        # Format and write records on a background thread so logging never blocks the caller
+        log_queue = queue.Queue(maxsize=queue_size)
+        logger.addHandler(_DeferredQueueHandler(log_queue, handlers))
+        DwellistLogger._listener = _QueueListener(
+            log_queue, *handlers, respect_handler_level=True
+        )
+        DwellistLogger._listener.start()
         return logger
+
+    @staticmethod
+    def _stop_listener():
+        """Flush the queued records and stop the listener thread, if one is running"""
+        if DwellistLogger._listener is not None:
+            DwellistLogger._listener.stop()
+            DwellistLogger._listener = None
+
+
+atexit.register(DwellistLogger._stop_listener)
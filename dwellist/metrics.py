@@ -0,0 +1,161 @@
+""" This module is responsible for collecting timings and counters across a scrape run. """
+import bisect
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+def _round(value):
+    return round(value, 3) if value is not None else None
+
+
+class Histogram:
+    """
+    Latency histogram with fixed, exponentially spaced buckets
+
+    Percentiles are estimated as the upper bound of the bucket they fall in, so memory stays
+    constant however many observations are made.
+    """
+
+    # Bucket upper bounds in milliseconds, 0.1 ms to about 100 s
+    BUCKETS = tuple(0.1 * 2 ** (i / 2) for i in range(40))
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, seconds: float) -> None:
+        milliseconds = seconds * 1000
+        self.counts[bisect.bisect_left(self.BUCKETS, milliseconds)] += 1
+        self.count += 1
+        self.total += milliseconds
+        self.min = milliseconds if self.min is None else min(self.min, milliseconds)
+        self.max = milliseconds if self.max is None else max(self.max, milliseconds)
+
+    def percentile(self, fraction: float) -> float:
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                if bucket == len(self.BUCKETS):
+                    break
+                return min(self.BUCKETS[bucket], self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "total_ms": round(self.total, 3),
+            "mean_ms": round(self.total / self.count, 3) if self.count else None,
+            "min_ms": round(self.min, 3) if self.min is not None else None,
+            "p50_ms": _round(self.percentile(0.5)),
+            "p90_ms": _round(self.percentile(0.9)),
+            "p99_ms": _round(self.percentile(0.99)),
+            "max_ms": round(self.max, 3) if self.max is not None else None,
+        }
+
+
+class Metrics:
+    """
+    Thread safe registry of counters and latency histograms
+
+    Names are dotted, e.g. "fetch.detail" or "parse.failures.title". One registry is shared by
+    the whole process as `metrics`.
+    """
+
+    # Listing fields whose absence after parsing counts as a parse failure
+    PARSED_FIELDS = (
+        "title",
+        "description",
+        "type",
+        "area",
+        "postcode",
+        "nearest_station",
+        "rooms",
+        "latitude",
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = defaultdict(int)
+        self.histograms = defaultdict(Histogram)
+        self.started = time.time()
+
+    def increment(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self.counters[name] += value
+
+    def observe(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self.histograms[name].observe(seconds)
+
+    @contextmanager
+    def timer(self, name: str):
+        """Time the body of a with block into the named histogram"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def record_listing(self, listing) -> None:
+        """Count the fields that could not be parsed from a listing page"""
+        self.increment("parse.listings")
+        if listing.id == -1:
+            self.increment("parse.failures.id")
+        for field in self.PARSED_FIELDS:
+            value = getattr(listing, field)
+            if value is None or value == [] or value == "Unknown Title":
+                self.increment(f"parse.failures.{field}")
+
+    def reset(self) -> None:
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.started = time.time()
+
+    def summary(self) -> dict:
+        """
+        Get every counter and histogram, with the cache hit rate derived from the cache counters
+
+        Fresh hits and stale pages revalidated with a 304 both count as hits.
+
+        :return: dictionary that can be serialised as JSON
+        """
+        with self._lock:
+            counters = dict(sorted(self.counters.items()))
+            histograms = {
+                name: histogram.summary() for name, histogram in sorted(self.histograms.items())
+            }
+        hits = counters.get("cache.hit", 0) + counters.get("cache.revalidated", 0)
+        lookups = sum(counters.get(f"cache.{name}", 0) for name in ("hit", "stale", "miss"))
+        return {
+            "started": self.started,
+            "elapsed_seconds": round(time.time() - self.started, 3),
+            "counters": counters,
+            "histograms": histograms,
+            "cache_hit_rate": round(hits / lookups, 4) if lookups else None,
+        }
+
+    def write_summary(self, path: str, **extra) -> dict:
+        """
+        Write the summary, plus any extra fields, to a JSON file
+
+        :param path: path of the JSON file
+        :return: the summary written
+        """
+        summary = {**extra, **self.summary()}
+        with open(path, "w", encoding="utf-8") as summary_file:
+            json.dump(summary, summary_file, indent=2)
+        return summary
+
+
+metrics = Metrics()
@@ -0,0 +1,355 @@
+""" This module is responsible for parsing listing and search pages straight from the lxml tree. """
+import hashlib
+import re
+from lxml import etree
+from lxml import html as lxml_html
+from dwellist.logger import DwellistLogger
+from dwellist.schema import feature_key
+
+
+def _text(element) -> str:
+    """
+    Text of an element as BeautifulSoup's .text gives it
+
+    BeautifulSoup collapses every text node made only of whitespace to a single newline, or a
+    space when it holds no newline; text_content() keeps them as they are. Collapsing them the
+    same way keeps the values the two parsers store identical.
+
+    :param element: lxml element
+    :return: text of the element and its descendants
+    """
+    return "".join(
+        text if text.strip(" \n\t\x0c\r") else "\n" if "\n" in text else " "
+        for text in element.itertext()
+    )
+
+
+def _has_class(class_name: str) -> str:
+    """XPath predicate matching elements whose class attribute contains class_name"""
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {class_name} ')"
+
+
+class ListingParser:
+    """
+    Single pass parser for SpareRoom listing detail pages
+
+    Produces the same fields as the BeautifulSoup based Listing constructor, but works on the
+    raw HTML with precompiled XPath selectors so the page is never re-serialised.
+    """
+
+    logger = DwellistLogger.get_logger()
+
+    UNAVAILABLE_MARKER = b"Sorry, this room is no longer available"
+    KEY_FEATURES = ("type", "area", "postcode", "nearest_station")
+
+    _listing_id = re.compile(rb"flatshare_id=(\d+)")
+    _location = re.compile(r"location\s*:?\s*\{([^}]*)\}")
+
+    _heading = etree.XPath("//div[@id='listing_heading']")
+    _heading_title = etree.XPath("h1")
+    _description = etree.XPath(f"//p[{_has_class('detaildesc')}]")
+    _key_features = etree.XPath(f"(//ul[{_has_class('key-features')}])[1]/li")
+    _room_list = etree.XPath(f"(//ul[{_has_class('room-list')}])[1]/li")
+    _room_price = etree.XPath(f".//strong[{_has_class('room-list__price')}]")
+    _room_type = etree.XPath(".//small")
+    _whole_property_price = etree.XPath(
+        f"(//section[{_has_class('feature--price-whole-property')}])[1]"
+        f"//h3[{_has_class('feature__heading')}]"
+    )
+    _feature_lists = etree.XPath(f"//dl[{_has_class('feature-list')}]")
+    _feature_keys = etree.XPath(".//dt")
+    _feature_values = etree.XPath(".//dd")
+    _main_image = etree.XPath(
+        "(//dl[@class='photo-gallery__main-image-wrapper landscape'])[1]//img/@src"
+    )
+    _thumbnails = etree.XPath(
+        "(//div[@class='photo-gallery__thumbnails photo-gallery__thumbnails--has-photos'])[1]"
+        "//a/@href"
+    )
+    _head_scripts = etree.XPath("/html/head//script")
+
+    def parse(self, content, domain: str) -> dict:
+        """
+        Parse a listing detail page
+
+        :param content: raw HTML of the listing page (bytes or str)
+        :param domain: listing URL prefix the listing id is appended to
+        :return: dictionary with one entry per Listing slot; rooms are (price, type) pairs
+        """
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        root = lxml_html.fromstring(content)
+
+        record = {}
+        record["id"] = self._get_id(content)
+        record["available"] = self.UNAVAILABLE_MARKER not in content
+        record["url"] = domain + str(record["id"])
+        record["title"] = self._get_title(root)
+        record["description"] = self._get_description(root)
+        record.update(self._get_key_features(root))
+        record["rooms"] = [
+            (room["price"], room["type"])
+            for room in self._get_room_prices_pm(root, record["url"])
+        ]
+
+        location_coords = self._get_location_coords(root)
+        record["latitude"] = location_coords[0] if location_coords else None
+        record["longitude"] = location_coords[1] if location_coords else None
+
+        record["main_image"], record["images"] = self._get_images(root)
+        record["features"] = self._get_features(root)
+        return record
+
+    def _get_id(self, content: bytes) -> int:
+        match = self._listing_id.search(content)
+        if match is None:
+            self.logger.error("Error parsing room id: no flatshare_id found")
+            return -1
+        return int(match.group(1))
+
+    def _get_title(self, root) -> str:
+        heading = self._heading(root)
+        if not heading:
+            self.logger.error("Could not extract header page title")
+            return "Unknown Title"
+        title = self._heading_title(heading[0])
+        return _text(title[0]).strip() if title else None
+
+    def _get_description(self, root) -> str:
+        description = self._description(root)
+        if not description:
+            return None
+        return _text(description[0]).strip().replace("\r\n", " ")
+
+    def _get_key_features(self, root) -> dict:
+        features = dict.fromkeys(self.KEY_FEATURES)
+        for i, (key, li) in enumerate(zip(self.KEY_FEATURES, self._key_features(root))):
+            text = " ".join(_text(li).replace("\n", "").split())
+            if i == 2:
+                text = text.split(" ")[0]
+            features[key] = text
+        return features
+
+    def _get_room_prices_pm(self, root, url: str) -> list:
+        room_prices = []
+        try:
+            rooms = self._room_list(root)
+            if not rooms:
+                whole_property_price = self._whole_property_price(root)
+                if not whole_property_price:
+                    raise AttributeError("No room price found")
+                price_text = _text(whole_property_price[0])
+                price = price_text.split("£")[1].split()[0]
+                room_prices.append({"price": price, "type": "Whole Property"})
+                return room_prices
+
+            for li in rooms:
+                price = _text(self._room_price(li)[0]).strip()
+                price, interval = price.split(" ")
+                price = price.replace("£", "")
+                if interval == "pw":
+                    price = int(int(price.replace(",", "")) * (52 / 12))
+                room_type = _text(self._room_type(li)[0]).strip()
+                room_type = room_type.replace("(", "").replace(")", "")
+                room_prices.append({"price": price, "type": room_type})
+        except (AttributeError, IndexError, ValueError) as e:
+            self.logger.error("Error parsing room price: %s", e)
+            self.logger.info(url)
+        return room_prices
+
+    def _get_features(self, root) -> dict:
+        features = {}
+        for feature_list in self._feature_lists(root):
+            keys = self._feature_keys(feature_list)
+            values = self._feature_values(feature_list)
+            for dt, dd in zip(keys, values):
+                features[feature_key(_text(dt))] = _text(dd).strip()
+        return features
+
+    def _get_images(self, root) -> tuple:
+        main_image = self._main_image(root)
+        if not main_image:
+            return None, []
+        images = [self._absolute_link(link) for link in self._thumbnails(root)]
+        return self._absolute_link(main_image[0]), images
+
+    def _get_location_coords(self, root):
+        for script in self._head_scripts(root):
+            script_text = script.text or ""
+            if "_sr.page" not in script_text:
+                continue
+            match = self._location.search(script_text)
+            if match is None:
+                continue
+            try:
+                values = match.group(1).split(",")[:-1]
+                location = [
+                    float(value.split(":")[1].strip().replace('"', ""))
+                    for value in values
+                ]
+                # latitude, longitude
+                return (location[0], location[1])
+            except (ValueError, IndexError) as e:
+                self.logger.debug("Error parsing location: %s", e)
+                return None
+        return None
+
+    @staticmethod
+    def _absolute_link(link: str) -> str:
+        """Ensure image links are prefixed with https:"""
+        return link if link.startswith("https:") else f"https:{link}"
+
+
+class SearchResultsParser:
+    """
+    Parser for SpareRoom search results pages
+
+    `parse` reads the id, featured flag and the summary fields shown on each result card in one
+    pass over the lxml tree. `listing_ids` is a faster path for when only the ids are needed: it
+    scans the raw bytes of each result article without building a tree at all.
+    """
+
+    ARTICLE_CLASS = "panel-listing-result"
+    FEATURED_MARKER = "listing-featured"
+
+    _article_start = re.compile(rb"<article\b[^>]*\bpanel-listing-result\b")
+    _article_end = re.compile(rb"</article\s*>")
+    _listing_id = re.compile(rb"flatshare_id=(\d+)")
+
+    _articles = etree.XPath(f"//article[{_has_class(ARTICLE_CLASS)}]")
+    _featured = etree.XPath(
+        f"boolean(descendant-or-self::*[contains(@class, '{FEATURED_MARKER}')])"
+    )
+    _links = etree.XPath(".//a/@href[contains(., 'flatshare_id=')]")
+    _title = etree.XPath("string(.//h2)")
+    _price = etree.XPath(f"string(.//*[{_has_class('listingPrice')}])")
+    _location = etree.XPath(f"string(.//*[{_has_class('listingLocation')}])")
+    _result_count = etree.XPath(f"string((//p[{_has_class('navcurrent')}])[1]/strong[2])")
+
+    def parse(self, content) -> list:
+        """
+        Parse every result card on a search results page
+
+        :param content: raw HTML of the search results page (bytes or str)
+        :return: list of dictionaries with id, featured, title, price and location
+        """
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        cards = []
+        for article in self._articles(lxml_html.fromstring(content)):
+            listing_id = self._card_id(article)
+            if listing_id is None:
+                continue
+            cards.append(
+                {
+                    "id": listing_id,
+                    "featured": self._featured(article),
+                    "title": " ".join(self._title(article).split()) or None,
+                    "price": " ".join(self._price(article).split()) or None,
+                    "location": " ".join(self._location(article).split()) or None,
+                }
+            )
+        return cards
+
+    def listing_ids(self, content) -> list:
+        """
+        Get the ids of the non-featured listings on a search results page from the raw bytes
+
+        :param content: raw HTML of the search results page (bytes or str)
+        :return: list of listing ids, in page order
+        """
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        listing_ids = []
+        position = 0
+        while match := self._article_start.search(content, position):
+            end = self._article_end.search(content, match.end())
+            position = end.end() if end else len(content)
+            article = content[match.start() : position]
+            if self.FEATURED_MARKER.encode() in article:
+                continue
+            listing_id = self._listing_id.search(article)
+            if listing_id:
+                listing_ids.append(int(listing_id.group(1)))
+        return listing_ids
+
+    def result_count(self, content) -> int:
+        """
+        Get the number of results the search reports ("Showing 1-10 of 436 results")
+
+        SpareRoom shows at most 1000 results, reported as "1000+".
+
+        :param content: raw HTML of the search results page (bytes or str)
+        :return: number of results, None if the page has no result count
+        """
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        count = self._result_count(lxml_html.fromstring(content)).strip().rstrip("+")
+        return int(count.replace(",", "")) if count else None
+
+    def _card_id(self, article) -> int:
+        data_id = article.get("data-listing-id")
+        if data_id and data_id.isdigit():
+            return int(data_id)
+        for link in self._links(article):
+            match = self._listing_id.search(link.encode("utf-8"))
+            if match:
+                return int(match.group(1))
+        return None
+
+
+_parser = ListingParser()
+_search_parser = SearchResultsParser()
+
+
+def parse_listing(content, domain: str) -> dict:
+    """
+    Parse a listing detail page with the shared ListingParser
+
+    :param content: raw HTML of the listing page (bytes or str)
+    :param domain: listing URL prefix the listing id is appended to
+    :return: dictionary of listing fields
+    """
+    return _parser.parse(content, domain)
+
+
+def parse_search_results(content) -> list:
+    """
+    Parse the result cards on a search results page with the shared SearchResultsParser
+
+    :param content: raw HTML of the search results page (bytes or str)
+    :return: list of dictionaries of card fields
+    """
+    return _search_parser.parse(content)
+
+
+def extract_listing_ids(content) -> list:
+    """
+    Get the non-featured listing ids on a search results page without building a tree
+
+    :param content: raw HTML of the search results page (bytes or str)
+    :return: list of listing ids
+    """
+    return _search_parser.listing_ids(content)
+
+
+def extract_result_count(content) -> int:
+    """
+    Get the number of results reported on a search results page
+
+    :param content: raw HTML of the search results page (bytes or str)
+    :return: number of results, None if the page has no result count
+    """
+    return _search_parser.result_count(content)
+
+
+def card_fingerprint(card: dict) -> str:
+    """
+    Fingerprint the fields a search result card shows, so a changed price or title can be
+    spotted without fetching the listing page
+
+    :param card: result card from parse_search_results
+    :return: hex digest
+    """
+    fields = "\x1f".join(card.get(field) or "" for field in ("title", "price", "location"))
+    return hashlib.blake2b(fields.encode("utf-8"), digest_size=8).hexdigest()
@@ -0,0 +1,320 @@
+""" This module is responsible for streaming listings from search pages through to storage. """
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from dwellist.capture import capture
+from dwellist.listing import Listing
+from dwellist.logger import DwellistLogger
+from dwellist.metrics import metrics
+from dwellist.parser import card_fingerprint, parse_listing, parse_search_results
+from dwellist.scraper import SpareRoomScraper
+
+
+class ScrapePipeline:
+    """
+    Streaming fetch -> parse -> persist pipeline
+
+    Search pages are fetched in order and their listing ids are queued as soon as each page
+    arrives. Detail fetchers, parsers and a single writer drain bounded queues, so only a
+    handful of pages are held in memory however many listings are scraped.
+
+    Several searches can share one run: each gets its own search page producer, while detail
+    pages are fetched, parsed and saved once however many searches matched the listing.
+    """
+
+    logger = DwellistLogger.get_logger()
+
+    def __init__(self, fetcher, persist, known_ids, config, crawl_state=None):
+        """
+        :param fetcher: AsyncFetcher shared by every search in the run
+        :param persist: callable saving a list of Listing objects
+        :param known_ids: KnownListingIds of listings that are already stored
+        :param config: scraper settings
+        :param crawl_state: ListingStore recording high-water marks and search matches, optional
+        """
+        self.fetcher = fetcher
+        self.persist = persist
+        self.known_ids = known_ids
+        self.crawl_state = crawl_state
+        self.domain = SpareRoomScraper.domain
+        self.incremental = config.get("incremental", False)
+        self.stop_after_known_pages = config.get("stop_after_known_pages", 1)
+        if self.incremental and config.get("sort_by") != "days_since_placed":
+            self.logger.warning("Incremental crawls expect sort_by to be days_since_placed")
+        self.parse_mode = config.get("parse_mode", "thread")
+        self.parser_workers = config.get("parser_workers")
+        self.fetch_workers = config.get("fetch_workers", 10)
+        self.queue_size = config.get("queue_size", 50)
+        self.persist_batch_size = config.get("persist_batch_size", 50)
+        self.persist_interval = config.get("persist_interval", 5)
+        self.refresh = config.get("refresh", False)
+        if self.refresh and crawl_state is None:
+            self.logger.warning("Refreshing changed listings needs a database, refresh is off")
+            self.refresh = False
+
+        # Listing id -> key of the first search that queued it
+        self.seen = {}
+        self.queued = 0
+        self.saved = 0
+        self.pages_fetched = 0
+        self.refreshed = 0
+        # Listing id -> search card fingerprint, recorded once the listing is saved
+        self.fingerprints = {}
+        # Stored listings whose search card changed, refetched past any fresh cached copy
+        self.changed = set()
+
+    async def run(self, searches: list) -> int:
+        """
+        Run the pipeline over one or more searches
+
+        :param searches: list of (SpareRoomScraper, number of search pages to crawl)
+        :return: number of listings saved
+        """
+        id_queue = asyncio.Queue(maxsize=self.queue_size)
+        page_queue = asyncio.Queue(maxsize=self.queue_size)
+        row_queue = asyncio.Queue(maxsize=self.queue_size)
+
+        executor_type = (
+            ProcessPoolExecutor if self.parse_mode == "process" else ThreadPoolExecutor
+        )
+        parse_workers = self.parser_workers or os.cpu_count() or 1
+        with executor_type(max_workers=parse_workers) as executor:
+            async with self.fetcher as fetcher:
+                fetchers = [
+                    asyncio.create_task(self._fetch_listings(fetcher, id_queue, page_queue))
+                    for _ in range(self.fetch_workers)
+                ]
+                parsers = [
+                    asyncio.create_task(self._parse_listings(executor, page_queue, row_queue))
+                    for _ in range(parse_workers)
+                ]
+                writer = asyncio.create_task(self._persist_listings(row_queue))
+                try:
+                    await asyncio.gather(
+                        *(
+                            self._produce_listing_ids(fetcher, scraper, page_count, id_queue)
+                            for scraper, page_count in searches
+                        )
+                    )
+                    await self._close_stage(id_queue, fetchers)
+                    await self._close_stage(page_queue, parsers)
+                    await self._close_stage(row_queue, [writer])
+                finally:
+                    for task in fetchers + parsers + [writer]:
+                        task.cancel()
+
+        self.logger.info(
+            "Saved %s of %s new listings from %s search pages",
+            self.saved,
+            self.queued,
+            self.pages_fetched,
+        )
+        if self.refresh:
+            self.logger.info("Refetched %s listings whose search card changed", self.refreshed)
+        return self.saved
+
+    async def _record_high_water_mark(self, search_key: str, high_water_id: int) -> None:
+        if self.crawl_state is None or high_water_id is None:
+            return
+        previous = await asyncio.to_thread(self.crawl_state.get_high_water_mark, search_key)
+        if previous is not None:
+            self.logger.debug(
+                "High-water mark for search %s: %s -> %s", search_key, previous, high_water_id
+            )
+        await asyncio.to_thread(
+            self.crawl_state.set_high_water_mark, search_key, high_water_id
+        )
+
+    @staticmethod
+    async def _close_stage(queue: asyncio.Queue, workers: list) -> None:
+        """Send one stop sentinel per worker and wait for the stage to drain"""
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+
+    async def _produce_listing_ids(self, fetcher, scraper, page_count: int, id_queue) -> None:
+        """
+        Fetch a search's result pages in order and queue every listing id not seen before
+
+        In incremental mode the results are expected newest first (sort_by=days_since_placed),
+        so the crawl stops once stop_after_known_pages consecutive pages hold no new listings,
+        unless refresh is on.
+        """
+        queued = 0
+        known_pages = 0
+        high_water_id = None
+        for offset in range(0, page_count * 10, 10):
+            if offset == 0 and scraper.first_page is not None:
+                # The first page was fetched when the search started
+                content = scraper.first_page
+            else:
+                # A refresh compares the cards as they are now, not as cached
+                result = await fetcher.fetch(
+                    f"{scraper.url}{offset}", "search", revalidate=self.refresh
+                )
+                if not result.ok:
+                    self.logger.error(
+                        "Failed to fetch search page %s: %s", result.url, result.error
+                    )
+                    continue
+                content = result.content
+            self.pages_fetched += 1
+            metrics.increment("pages.search")
+
+            if self.refresh:
+                cards = [card for card in parse_search_results(content) if not card["featured"]]
+                page_ids = [card["id"] for card in cards]
+            else:
+                page_ids = scraper.extract_listing_ids(content)
+            # Checked for the whole page at once, off the event loop, as a Bloom filter index
+            # confirms its matches in the database
+            stored_ids = await asyncio.to_thread(self.known_ids.stored, page_ids)
+            changed = await self._changed_listings(cards, stored_ids) if self.refresh else ()
+            if self.crawl_state is not None and page_ids:
+                await asyncio.to_thread(
+                    self.crawl_state.record_search_matches, scraper.search_key, page_ids
+                )
+
+            new_on_page = 0
+            for listing_id in page_ids:
+                high_water_id = max(high_water_id or listing_id, listing_id)
+                stored = listing_id in stored_ids
+                # A listing another search queued this run is not stored yet, so it still
+                # counts as new for the incremental stop
+                if not stored:
+                    new_on_page += 1
+                if listing_id in self.seen or (stored and listing_id not in changed):
+                    self.logger.debug("%s already logged", listing_id)
+                    continue
+                if listing_id in changed:
+                    self.changed.add(listing_id)
+                    self.refreshed += 1
+                self.seen[listing_id] = scraper.search_key
+                await id_queue.put(listing_id)
+                queued += 1
+                self.queued += 1
+                if queued >= scraper.listings_to_scrape:
+                    break
+
+            if queued >= scraper.listings_to_scrape:
+                self.logger.info("Limit of %s reached", scraper.listings_to_scrape)
+                break
+            # A refresh compares the cards on every page, so it never stops early
+            if self.incremental and not self.refresh:
+                known_pages = 0 if new_on_page else known_pages + 1
+                if known_pages >= self.stop_after_known_pages:
+                    self.logger.info(
+                        "Stopping after %s search page(s) with no new listings", known_pages
+                    )
+                    break
+
+        await self._record_high_water_mark(scraper.search_key, high_water_id)
+
+    async def _changed_listings(self, cards: list, stored_ids: set) -> set:
+        """
+        Compare the result cards on a search page with their stored fingerprints
+
+        Stored listings whose card is unchanged, or that have no fingerprint yet, have their
+        fingerprint recorded straight away and are not fetched. The fingerprints of changed and
+        new listings are held until the listing is saved, so a failed fetch is retried next run.
+
+        :param cards: non-featured result cards from parse_search_results
+        :param stored_ids: ids of the listings on the page that are already stored
+        :return: ids of stored listings whose card changed
+        """
+        fingerprints = {card["id"]: card_fingerprint(card) for card in cards}
+        stored = await asyncio.to_thread(self.crawl_state.get_fingerprints, list(fingerprints))
+        changed = {
+            listing_id
+            for listing_id, fingerprint in fingerprints.items()
+            if listing_id in stored_ids
+            and listing_id in stored
+            and stored[listing_id] != fingerprint
+        }
+        unchanged = {
+            listing_id: fingerprint
+            for listing_id, fingerprint in fingerprints.items()
+            if listing_id in stored_ids and listing_id not in changed
+        }
+        if unchanged:
+            await asyncio.to_thread(self.crawl_state.set_fingerprints, unchanged)
+        for listing_id, fingerprint in fingerprints.items():
+            if listing_id not in unchanged:
+                self.fingerprints[listing_id] = fingerprint
+        metrics.increment("refresh.changed", len(changed))
+        metrics.increment("refresh.unchanged", len(unchanged))
+        return changed
+
+    async def _fetch_listings(self, fetcher, id_queue, page_queue) -> None:
+        """Fetch the detail page of each queued listing id"""
+        while (listing_id := await id_queue.get()) is not None:
+            result = await fetcher.fetch(
+                self.domain + str(listing_id),
+                "detail",
+                revalidate=listing_id in self.changed,
+            )
+            if not result.ok:
+                self.logger.error("Failed to fetch listing %s: %s", listing_id, result.error)
+                continue
+            await page_queue.put(result.content)
+
+    async def _parse_listings(self, executor, page_queue, row_queue) -> None:
+        """Parse each fetched detail page into a Listing in the executor"""
+        loop = asyncio.get_running_loop()
+        parse = partial(parse_listing, domain=self.domain)
+        while (content := await page_queue.get()) is not None:
+            try:
+                with metrics.timer("parse"):
+                    record = await loop.run_in_executor(executor, parse, content)
+            except Exception as e:
+                metrics.increment("parse.errors")
+                self.logger.error("Failed to parse listing: %s", e)
+                capture.failed(content)
+                continue
+            listing = Listing.from_record(record)
+            metrics.record_listing(listing)
+            capture.listing(content, listing)
+            await row_queue.put(listing)
+
+    async def _persist_listings(self, row_queue) -> None:
+        """Save parsed listings in batches, flushing at least every persist_interval seconds"""
+        batch = []
+        while True:
+            try:
+                listing = await asyncio.wait_for(
+                    row_queue.get(), timeout=self.persist_interval
+                )
+            except asyncio.TimeoutError:
+                if batch:
+                    await self._flush(batch)
+                    batch = []
+                continue
+
+            if listing is None:
+                break
+            batch.append(listing)
+            if len(batch) >= self.persist_batch_size:
+                await self._flush(batch)
+                batch = []
+
+        if batch:
+            await self._flush(batch)
+
+    async def _flush(self, batch: list) -> None:
+        try:
+            with metrics.timer("persist"):
+                await asyncio.to_thread(self.persist, batch)
+            self.known_ids.update(listing.id for listing in batch)
+            fingerprints = {
+                listing.id: self.fingerprints.pop(listing.id)
+                for listing in batch
+                if listing.id in self.fingerprints
+            }
+            if fingerprints:
+                await asyncio.to_thread(self.crawl_state.set_fingerprints, fingerprints)
+            self.saved += len(batch)
+            self.logger.debug("Saved %s listings", len(batch))
+        except Exception as e:
+            metrics.increment("persist.errors")
+            self.logger.error("Failed to save %s listings: %s", len(batch), e)
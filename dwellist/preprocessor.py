@@ -1,6 +1,241 @@
+""" This module is responsible for normalising batches of scraped listings into typed columns. """
+import numpy as np
+import pandas as pd
+from pandas import DataFrame, Series
+from dwellist.listing import Listing
+from dwellist.schema import feature_key
+
+
 class DataProcessor:
+    """
+    Batch normalisation of scraped listings
+
+    The parser keeps the strings it finds on the page ("1,050", "£1,211.54", "Yes", "1 Dec 2023").
+    `process` turns a whole batch of them into typed columns at once: room prices become whole
+    pounds per month, yes/no features booleans, money features floats, counts integers, terms
+    months and dates datetimes. Every step is a pandas string or numeric operation over a whole
+    column rather than Python code per value.
+    """
+
+    BASE_FIELDS = (
+        "id",
+        "available",
+        "url",
+        "title",
+        "description",
+        "type",
+        "area",
+        "postcode",
+        "nearest_station",
+        "latitude",
+        "longitude",
+        "main_image",
+    )
+    # Feature keys renamed where they would clash with a listing field
+    FEATURE_RENAMES = {"available": "available_from"}
+    # Features holding a date, "Now" meaning the day the listing was scraped
+    DATE_FEATURES = ("available_from",)
+    WEEKS_PER_MONTH = 52 / 12
+
+    _money = r"£\s*[\d,]+(?:\.\d+)?"
+    _integer = r"\d+"
+    _term = r"(?:\d+ (?:month|year)s?|none)"
+
     def __init__(self, config):
         self.config = config
 
-    def process(self, data):
-        pass
+    def process(self, data) -> DataFrame:
+        """
+        Normalise a batch of listings into typed columns
+
+        :param data: list of Listing objects or records, or a DataFrame in the csv layout
+        :return: DataFrame with one row per listing: the listing fields, room_<n>_price_pcm and
+            room_<n>_type per room, room_count, min_price_pcm, max_price_pcm and one column per
+            feature
+        """
+        records = self._to_records(data)
+        if not records:
+            return DataFrame()
+
+        listings = DataFrame.from_records(
+            [{field: record.get(field) for field in self.BASE_FIELDS} for record in records],
+            columns=list(self.BASE_FIELDS),
+        )
+        for field in self.BASE_FIELDS:
+            if field not in ("id", "available", "latitude", "longitude"):
+                listings[field] = listings[field].astype("string")
+        listings["id"] = pd.to_numeric(listings["id"], errors="coerce").astype("Int64")
+        listings["available"] = (
+            listings["available"]
+            .astype("string")
+            .str.lower()
+            .map({"true": True, "false": False})
+            .astype("boolean")
+        )
+        for field in ("latitude", "longitude"):
+            listings[field] = pd.to_numeric(listings[field], errors="coerce")
+        listings["date_scraped"] = pd.to_datetime(
+            Series([record.get("date_scraped") for record in records], dtype="string"),
+            format="%d-%m-%Y",
+            errors="coerce",
+        )
+
+        rooms = self.rooms(records)
+        return pd.concat(
+            [
+                listings,
+                self._room_columns(rooms, len(records)),
+                self.room_summary(rooms, len(records)),
+                self.features(records, listings["date_scraped"]),
+            ],
+            axis=1,
+        )
+
+    def rooms(self, records: list) -> DataFrame:
+        """
+        Get every room of a batch of listings with its price per month
+
+        :param records: list of Listing records (see Listing.to_record)
+        :return: DataFrame with listing (position in records), room_no, price_pcm and type
+        """
+        rows = [
+            (listing_no, room_no, price, room_type)
+            for listing_no, record in enumerate(records)
+            for room_no, (price, room_type) in enumerate(record.get("rooms") or [], 1)
+        ]
+        rooms = DataFrame(rows, columns=["listing", "room_no", "price", "type"])
+        rooms["price_pcm"] = self.parse_prices(rooms["price"])
+        rooms["type"] = rooms["type"].astype("string")
+        return rooms[["listing", "room_no", "price_pcm", "type"]]
+
+    def parse_prices(self, prices: Series) -> Series:
+        """
+        Parse room prices ("£1,050 pcm", "£240 pw", "1,050" or 974) to whole pounds per month
+
+        :param prices: Series of prices as the parser or csv left them
+        :return: Series of Int64, missing where the price could not be read
+        """
+        text = prices.astype("string").str.lower()
+        weekly = text.str.contains(r"\bpw\b|per week", regex=True).fillna(False).astype(bool)
+        amount = pd.to_numeric(text.str.replace(r"[^\d.]", "", regex=True), errors="coerce")
+        amount = amount.where(~weekly, amount * self.WEEKS_PER_MONTH)
+        return np.floor(amount.astype("float64")).astype("Int64")
+
+    @staticmethod
+    def room_summary(rooms: DataFrame, listing_count: int) -> DataFrame:
+        """
+        Count the rooms of each listing and find its cheapest and dearest room
+
+        :param rooms: DataFrame from rooms
+        :param listing_count: number of listings in the batch
+        :return: DataFrame with room_count, min_price_pcm and max_price_pcm, one row per listing
+        """
+        by_listing = rooms.groupby("listing")
+        summary = DataFrame(
+            {
+                "room_count": by_listing.size(),
+                "min_price_pcm": by_listing["price_pcm"].min(),
+                "max_price_pcm": by_listing["price_pcm"].max(),
+            }
+        ).reindex(range(listing_count))
+        summary["room_count"] = summary["room_count"].fillna(0).astype("int16")
+        for column in ("min_price_pcm", "max_price_pcm"):
+            summary[column] = summary[column].astype("Int64")
+        return summary
+
+    @staticmethod
+    def _room_columns(rooms: DataFrame, listing_count: int) -> DataFrame:
+        """Spread rooms into room_<n>_price_pcm and room_<n>_type columns, one row per listing"""
+        if rooms.empty:
+            return DataFrame(index=range(listing_count))
+        prices = rooms.pivot(index="listing", columns="room_no", values="price_pcm")
+        types = rooms.pivot(index="listing", columns="room_no", values="type")
+        columns = {}
+        for room_no in prices.columns:
+            columns[f"room_{room_no}_price_pcm"] = prices[room_no].astype("Int64")
+            columns[f"room_{room_no}_type"] = types[room_no].astype("string")
+        return DataFrame(columns).reindex(range(listing_count))
+
+    def features(self, records: list, date_scraped: Series) -> DataFrame:
+        """
+        Spread the features of a batch of listings into one typed column per canonical key
+
+        :param records: list of Listing records (see Listing.to_record)
+        :param date_scraped: scrape date of each listing, used where a date feature says "Now"
+        :return: DataFrame with one row per listing
+        """
+        features = DataFrame.from_records([record.get("features") or {} for record in records])
+        if features.empty:
+            return DataFrame(index=range(len(records)))
+        features.columns = self.canonical_keys(features.columns)
+        features = features.rename(columns=self.FEATURE_RENAMES)
+        features.columns = [
+            f"feature_{key}" if key in self.BASE_FIELDS or key == "date_scraped" else key
+            for key in features.columns
+        ]
+        if features.columns.has_duplicates:
+            # Raw keys that canonicalise to the same key keep the first value found
+            features = DataFrame(
+                {
+                    key: features.loc[:, features.columns == key].bfill(axis=1).iloc[:, 0]
+                    for key in dict.fromkeys(features.columns)
+                }
+            )
+        return DataFrame(
+            {
+                column: self._coerce(column, features[column], date_scraped)
+                for column in features.columns
+            }
+        )
+
+    @staticmethod
+    def canonical_keys(keys) -> pd.Index:
+        """
+        Canonicalise raw feature labels ("Bills included?", "Total # rooms") through the shared
+        memoised schema; canonical keys come back unchanged
+
+        :param keys: feature labels
+        :return: Index of canonical keys
+        """
+        return pd.Index([feature_key(str(key)) for key in keys], dtype="object")
+
+    def _coerce(self, name: str, values: Series, date_scraped: Series) -> Series:
+        """Convert a feature column to the type every one of its values fits"""
+        text = values.astype("string").str.strip()
+        present = text.dropna().str.lower()
+        if present.empty:
+            return text
+
+        if name in self.DATE_FEATURES:
+            dates = pd.to_datetime(text, format="%d %b %Y", errors="coerce")
+            now = text.str.lower().eq("now").fillna(False).astype(bool)
+            return dates.where(~now, date_scraped)
+        if present.isin(["yes", "no"]).all():
+            return text.str.lower().map({"yes": True, "no": False}).astype("boolean")
+        if present.str.fullmatch(self._money).all():
+            return pd.to_numeric(text.str.replace(r"[£,\s]", "", regex=True), errors="coerce")
+        if present.str.fullmatch(self._integer).all():
+            return pd.to_numeric(text, errors="coerce").astype("Int64")
+        if present.str.fullmatch(self._term).all():
+            term = text.str.lower().str.extract(r"^(\d+) (month|year)")
+            months = pd.to_numeric(term[0], errors="coerce")
+            months = months.where(term[1] != "year", months * 12)
+            return months.astype("Int64")
+        return text
+
+    @staticmethod
+    def _to_records(data) -> list:
+        if data is None:
+            return []
+        if isinstance(data, DataFrame):
+            return [Listing.from_dict(row).to_record() for row in data.to_dict("records")]
+        records = []
+        for item in data:
+            if isinstance(item, Listing):
+                records.append(item.to_record())
+            elif "rooms" in item:
+                records.append(item)
+            else:
+                # Flat rows in the csv layout
+                records.append(Listing.from_dict(item).to_record())
+        return records
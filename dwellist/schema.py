@@ -0,0 +1,86 @@
+""" This module is responsible for naming and ordering listing columns the same way everywhere. """
+import sys
+from functools import lru_cache
+
+# Spaces, dashes, slashes, parentheses, quotes, colons, periods, commas, ampersands and question
+# marks in feature labels all become underscores
+FEATURE_KEY_TABLE = str.maketrans(" -/()':.,&?", "___________")
+
+
+@lru_cache(maxsize=4096)
+def feature_key(label: str) -> str:
+    """
+    Canonicalise a feature label from a listing page ("Bills included?", "Total # rooms")
+
+    The same few dozen labels appear on every listing, so keys are memoised and interned: every
+    listing's features dictionary shares one string object per key.
+
+    :param label: text of the feature's <dt>
+    :return: canonical key, e.g. "bills_included"
+    """
+    key = label.replace("\n", "").replace("#", "").strip().lower()
+    return sys.intern(key.translate(FEATURE_KEY_TABLE).strip("_"))
+
+
+@lru_cache(maxsize=None)
+def room_columns(room_no: int) -> tuple:
+    """
+    :param room_no: room number, from 1
+    :return: interned (price column, type column) of the csv layout, e.g. ("room_1_price", "room_1_type")
+    """
+    return sys.intern(f"room_{room_no}_price"), sys.intern(f"room_{room_no}_type")
+
+
+@lru_cache(maxsize=None)
+def image_column(image_no: int) -> str:
+    """
+    :param image_no: image number, from 1
+    :return: interned image column of the csv layout, e.g. "image_1"
+    """
+    return sys.intern(f"image_{image_no}")
+
+
+class ColumnSchema:
+    """
+    The order csv columns are written in
+
+    Columns starting with one of GROUPS are moved to the end, group by group, and every other
+    column keeps its place in the DataFrame, so each DataFrame is ordered on its own columns
+    alone. The group of each column name is looked up once and memoised, which makes ordering
+    a DataFrame's columns a dictionary lookup per column and a stable sort.
+    """
+
+    GROUPS = ("listing_", "deposit", "image")
+
+    def __init__(self):
+        self._ranks = {}
+
+    def rank(self, column: str) -> int:
+        """
+        :param column: column name
+        :return: 0 for columns outside GROUPS, otherwise 1 + the index of the column's group
+        """
+        rank = self._ranks.get(column)
+        if rank is None:
+            rank = next(
+                (
+                    position
+                    for position, group in enumerate(self.GROUPS, 1)
+                    if column.startswith(group)
+                ),
+                0,
+            )
+            self._ranks[sys.intern(str(column))] = rank
+        return rank
+
+    def order(self, columns) -> list:
+        """
+        Put columns in the csv order
+
+        :param columns: column names
+        :return: list of the same columns, in order
+        """
+        return sorted(columns, key=self.rank)
+
+
+schema = ColumnSchema()
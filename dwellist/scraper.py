@@ -1,389 +1,354 @@
-import traceback
-import httpx
-import asyncio
-from pandas import DataFrame
 import requests
-from bs4 import BeautifulSoup as Soup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from dwellist.capture import capture
 from dwellist.listing import Listing
 from dwellist.logger import DwellistLogger
+from dwellist.metrics import metrics
 from dwellist.searchconstructor import SearchConstructor
-from concurrent.futures import ThreadPoolExecutor
+from dwellist.parser import extract_listing_ids, extract_result_count
+from dwellist.fetcher import AsyncFetcher, BlockingHostRateLimiter
+from dwellist.known_ids import KnownListingIds
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from collections import deque
+from itertools import islice
+from urllib.parse import urlsplit
 
 
 class SpareRoomScraper:
     """Scrape listings from SpareRoom"""
 
     domain = "https://www.spareroom.co.uk/flatshare/flatshare_detail.pl?flatshare_id="
-    scraped_listings = []
+    # Search pages crawl_threaded fetches ahead of the one it is reading
+    SEARCH_PAGES_AHEAD = 2
     logger = DwellistLogger.get_logger()
 
-    def __init__(self, config):
+    def __init__(self, config, fetcher: AsyncFetcher = None, search_page: tuple = None):
+        """
+        Use `create` from async code: it fetches the first search page without blocking.
+
+        :param config: search config
+        :param fetcher: AsyncFetcher to share with other scrapers, one is created if omitted
+        :param search_page: (results URL, raw HTML) of the first search results page, fetched
+            here with a blocking request if omitted
+        """
         search_constructor = SearchConstructor(config)
         self.url_search = search_constructor.get_search_url()
+        self.search_key = search_constructor.get_search_key()
         self.config = config
         self.listings_to_scrape = config["listings_to_scrape"]
-        self.session = requests.Session()
+        self.fetch_workers = config.get("fetch_workers", 10)
+        self.request_timeout = config.get("request_timeout", 20)
+        self.session = self._create_session(config)
+        self.rate_limiter = BlockingHostRateLimiter(config.get("requests_per_second", 5))
+        self.fetcher = fetcher if fetcher is not None else AsyncFetcher(config)
         self.already_logged = 0
-        self.unavailable_listings = 0
-        with self.session as session:
-            request = session.get(self.url_search)
+        if search_page is None:
+            request = self.session.get(self.url_search, timeout=self.request_timeout)
             request.raise_for_status()
-            self.scraper = Soup(request.content, "lxml")
-            self.logger.debug(f"URL: {request.url}")
+            search_page = (request.url, request.content)
+        results_url, self.first_page = search_page
+        self.logger.debug("URL: %s", results_url)
 
-        self.listings = []
-        self.url = f"{request.url}offset="
+        # The search redirects to its results, which are paged by appending an offset
+        self.url = f"{results_url}offset="
 
         # ! New variables
         self.pages = []
         self.limit = self.config["listings_to_scrape"]
 
-    def _get_soup(self, url: str) -> Soup:
-        """
-        Gets HTML from the URL then gives it to the Soup library to organise in a way that makes it easy to find the specific information we need.
-
-        :param url: URL to get HTML from
-        :return: Soup object
+    @classmethod
+    async def create(cls, config, fetcher: AsyncFetcher = None):
         """
-        soup_object = None
+        Start a search and build its scraper without blocking the event loop
 
-        try:
-            response = self.session.get(url, allow_redirects=False)
-            response.raise_for_status()
-
-            if response.status_code == 200:
-                soup_object = Soup(response.content, "lxml")
-            elif response.status_code == 302:
-                self.logger.warning("302 redirect")
-                traceback.print_stack()
+        The first results page is kept and reused as page 0 of the crawl, so starting a search
+        costs one request.
 
-        except requests.RequestException as e:
-            self.logger.error("Request error: %s", e)
+        :param config: search config
+        :param fetcher: AsyncFetcher to share with other scrapers, one is created if omitted
+        :return: SpareRoomScraper
+        """
+        fetcher = fetcher if fetcher is not None else AsyncFetcher(config)
+        url_search = SearchConstructor(config).get_search_url()
+        async with fetcher:
+            result = await fetcher.fetch(url_search, "search", follow_redirects=True)
+        if not result.ok:
+            raise requests.HTTPError(f"Failed to start search {url_search}: {result.error}")
+        return cls(config, fetcher=fetcher, search_page=(result.url, result.content))
+
+    def _create_session(self, config) -> requests.Session:
+        """
+        Session whose connection pool is shared by fetch_workers threads
 
-        return soup_object
+        429/5xx responses are retried with exponential backoff, honouring Retry-After, like the
+        AsyncFetcher does.
 
-    def _process_listing(
-        self, new_listing: Soup, old_listings: DataFrame, logged_listings: list
-    ) -> Listing:
+        :param config: search config
+        :return: requests Session
         """
-        Process a listing and return a Listing object
+        retries = Retry(
+            total=config.get("max_retries", 3),
+            backoff_factor=config.get("backoff_base", 0.5),
+            status_forcelist=AsyncFetcher.RETRY_STATUS_CODES,
+            allowed_methods=["GET"],
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self.fetch_workers,
+            pool_block=True,
+            max_retries=retries,
+        )
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
 
-        :param listing: Soup object of listing
-        :param previous_listings: DataFrame of previously scraped listings
-        :param logged_listings: list of listing ids that have already been scraped
-        :return: Listing object
+    def _get_page(self, url: str, page_type: str) -> bytes:
         """
-        # NOTE: Debugging purposes
-        with open("listing.txt", "w", encoding="utf-8") as file:
-            file.write(new_listing.prettify())
+        Fetch a page over the pooled session from a worker thread
 
+        :param url: URL to fetch
+        :param page_type: "search" or "detail", names the latency histogram
+        :return: raw HTML, None if the request failed
+        """
+        self.rate_limiter.wait(urlsplit(url).netloc)
+        metrics.increment("fetch.requests")
         try:
-            listing_id = int(
-                new_listing.prettify().split("flatshare_id=")[1].split("&")[0]
-            )
-        except (KeyError, ValueError, IndexError) as e:
-            self.logger.error("Error parsing listing id: %s", e)
-
-        if "Sorry, this listing is no longer available" in new_listing.prettify():
-            self.logger.debug(f"Listing {listing_id} no longer available")
-            self.unavailable_listings += 1
+            with metrics.timer(f"fetch.{page_type}"):
+                response = self.session.get(url, timeout=self.request_timeout)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            metrics.increment("fetch.errors")
+            self.logger.error("Failed to fetch %s: %s", url, e)
             return None
+        metrics.increment("fetch.bytes", len(response.content))
+        return response.content
 
-        add_new_listing = True
-        if old_listings is not None and not old_listings.empty:
-            add_new_listing = listing_id not in logged_listings
-
-        if not add_new_listing:
-            self.logger.debug(f"{listing_id} already logged")
-            self.scraped_listings.append(listing_id)
-            # If listing_id is in SCRAPED_ROOMS twice, something's wrong
-            if self.scraped_listings.count(listing_id) > 1:
-                self.logger.error(f"Listing {listing_id} already logged twice")
-                return None
-            self.already_logged += 1
-
-        return Listing(new_listing, self.domain)
+    def _fetch_listing(self, listing_id: int) -> Listing:
+        """Fetch and parse a listing page, run in a worker thread"""
+        content = self._get_page(self.domain + str(listing_id), "detail")
+        if content is None:
+            return None
+        return self._convert_to_listing(content)
 
-    def _get_listings_info(self, listings: Soup, previous_listings=None) -> list:
+    def crawl_threaded(self, known_ids=None, page_count: int = None) -> list:
         """
-        Get the listings from the search results page
+        Crawl the search with worker threads instead of asyncio
 
-        :param listings: Soup object of search results page
-        :param previous_listings: DataFrame of previously scraped listings
+        Search pages are fetched at most SEARCH_PAGES_AHEAD pages ahead of the one being read,
+        and read in order, so the listing limit is applied in page order and no search page
+        beyond the limit is requested. Each new listing is then fetched and parsed by a worker.
+        At most "queue_size" listings are in flight at once, so a large crawl never holds more
+        than that many pages in memory.
+
+        :param known_ids: KnownListingIds of listings that are already stored
+        :param page_count: number of search pages to crawl, read from the first page if omitted
         :return: list of Listing objects
         """
-        # Create a list to store the futures
-        listings = []
-        scraped_listings = listings.find_all("article", class_="panel-listing-result")
-
-        # Ensure listing-features is not included in scraped_listings
-        scraped_listings = [
-            listing
-            for listing in scraped_listings
-            if "listing-featured" not in str(listing)
-        ]
-
-        logged_listings = (
-            previous_listings["id"].values.tolist()
-            if not previous_listings.empty
-            else []
-        )
-
-        futures = []
-        # Create a ThreadPoolExecutor with a limited number of threads
-        with ThreadPoolExecutor() as executor:
-            # Process each listing in parallel
-            for i, listing in enumerate(scraped_listings):
-                listing_id = listing.prettify().split("flatshare_id=")[1].split("&")[0]
-                if listing_id in logged_listings:
-                    self.logger.debug(f"{listing_id} already logged")
-                    self.already_logged += 1
-                    continue
-                listing_url = str(self.domain + listing_id)
-                # Get the listing
-                listing = Soup(requests.get(listing_url).content, "lxml")
-                future = executor.submit(self._convert_to_listing, listing)
-                futures.append(future)
+        if known_ids is None:
+            known_ids = KnownListingIds()
+        if page_count is None:
+            page_count = -(-self.get_total_results() // 10)
+        max_in_flight = self.config.get("queue_size", 50)
 
-        # Retrieve the results from the futures
         listings = []
-        for future in futures:
-            listing_obj = future.result()
-            if listing_obj:
-                listings.append(listing_obj)
-        return listings
-
-    def _count_available_listings(self, listings: Soup) -> int:
-        """
-        Count the number of available listings for scraping on the search results page
+        queued = set()
+        pending = set()
+        search_urls = iter([f"{self.url}{offset}" for offset in range(10, page_count * 10, 10)])
+        search_futures = deque()
+
+        def collect(futures):
+            for future in futures:
+                listing = future.result()
+                if listing is not None:
+                    listings.append(listing)
+
+        with ThreadPoolExecutor(max_workers=self.fetch_workers) as executor:
+
+            def fetch_ahead():
+                for url in islice(search_urls, self.SEARCH_PAGES_AHEAD - len(search_futures)):
+                    search_futures.append(executor.submit(self._get_page, url, "search"))
+
+            def search_pages():
+                fetch_ahead()
+                # Page 0 was fetched when the search started
+                if page_count > 0:
+                    yield self.first_page
+                while search_futures:
+                    future = search_futures.popleft()
+                    fetch_ahead()
+                    yield future.result()
+
+            for page in search_pages():
+                if page is None:
+                    continue
+                metrics.increment("pages.search")
+                for listing_id in self.extract_listing_ids(page):
+                    if listing_id in queued or listing_id in known_ids:
+                        self.logger.debug("%s already logged", listing_id)
+                        self.already_logged += 1
+                        continue
+                    if len(pending) >= max_in_flight:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        collect(done)
+                    queued.add(listing_id)
+                    pending.add(executor.submit(self._fetch_listing, listing_id))
+                    if len(queued) >= self.listings_to_scrape:
+                        break
+                if len(queued) >= self.listings_to_scrape:
+                    self.logger.info("Limit of %s reached", self.listings_to_scrape)
+                    break
 
-        :param listings: Soup object of search results page
-        :return: number of available listings for scraping
-        """
-        num_available_listings = 0
+            # Search pages fetched ahead of the limit are not needed
+            for future in search_futures:
+                future.cancel()
+            collect(wait(pending).done)
 
-        try:
-            listings = listings.find_all("article", class_="panel-listing-result")
-            # Exclude listing-featured listings
-            listings = [
-                listing
-                for listing in listings
-                if "listing-featured" not in str(listing)
-            ]
-            num_available_listings = len(listings)
-        except Exception as e:
-            self.logger.error("Error occurred: {}".format(e))
-            self.logger.error(traceback.format_exc())
-        return num_available_listings
+        self.logger.info("Scraped %s of %s new listings", len(listings), len(queued))
+        return listings
 
     def get_total_results(self) -> int:
         """
         Get the total number of listings available to scrape
 
+        Read from the first search page, so no request is made.
+
         :return: number of listings available to scrape
         """
-        listings_per_page = 10
+        num_listings = self.listings_to_scrape
         try:
-            page = self._get_soup(self.url)
-            num_listings_on_last_page = self._count_available_listings(page)
-
-            most_possible_listings = self._get_max_page_count() * listings_per_page
-            available_listings = (
-                most_possible_listings + num_listings_on_last_page
-                if most_possible_listings < 1000
-                else 1000
-            )
-
-            listings_to_scrape = min(self.listings_to_scrape, most_possible_listings)
-
-            num_listings = (
-                listings_to_scrape
-                if listings_to_scrape < available_listings
-                else available_listings
-            )
+            # NOTE: SpareRoom will only ever show you, at most, 1000 results
+            available_listings = min(self._get_max_page_count(), 1000)
+            num_listings = min(self.listings_to_scrape, available_listings)
             self.logger.info(f"Available Listings: {available_listings}")
-            self.logger.info(f"Scrape Limit: {listings_to_scrape} listings")
+            self.logger.info(f"Scrape Limit: {self.listings_to_scrape} listings")
             self.logger.info(f"Scraping {num_listings} listings")
         except Exception as e:
             self.logger.error("Failed to discover number of listings: {}".format(e))
         return num_listings
 
-    def get_next_ten_listings(self, previous_listings=None, input=0) -> list:
-        """
-        Get the next ten listings from the search results page
-
-        :param previous_listings: DataFrame of previously scraped listings
-        :param input: A factor for a start index for the scraping process
-        :return: list of Listing objects
-        """
-        start_index = input * 10
-        end_index = start_index + 10
-
-        if start_index >= self.listings_to_scrape:
-            return None
-
-        if input == 0:
-            self.logger.info(
-                f"{'New':^15}{'Exists':^15}{'Unavailable':^15}{'Total':^15}"
-            )
-
-        for i in range(start_index, min(end_index, self.listings_to_scrape), 10):
-            url = f"{self.url}{i}"
-
-            soup = self._get_soup(url)
-
-            if soup:
-                self.listings.extend(self._get_listings_info(soup, previous_listings))
-                total_listings = (
-                    len(self.listings) + self.already_logged + self.unavailable_listings
-                )
-                self.logger.info(
-                    f"{len(self.listings):^15}{self.already_logged:^15}{self.unavailable_listings:^15}{total_listings:^15}"
-                )
-        return self.listings
-
     def _get_max_page_count(self) -> int:
         """
-        Get the maximum number of pages to scrape represented by the offset value from the page
+        Get the number of results the search reports on its first page
 
-        The offset value represents the number of listings
+        The result count bounds the offsets worth crawling. SpareRoom reports at most 1000,
+        shown as "1000+".
 
-        :return: maximum number of pages to scrape
+        :return: number of results
         """
-        # Find the navigation bar
-        navbar = self.scraper.find("p", {"class": "navcurrent"})
-
-        # Detect all values within strong tags
-        navbar_item = navbar.findAll("strong")
-
-        # Extract the number of listings from the second strong tag
-        result_quantity = navbar_item[1]
-
-        # NOTE: In some situations, it may say the maximum value of 1000 accompanied by a '+'
-        # NOTE: SpareRoom will only ever show you, at most, 1000 results; even if there are more (it just means you need to be more specific with your search)
-        listing_offset = int(
-            result_quantity.string[:-1]
-            if not result_quantity.string.endswith("+")
-            else result_quantity.string[:-2]
-        )
-
-        return listing_offset
+        result_count = extract_result_count(self.first_page)
+        if result_count is None:
+            raise ValueError("No result count on the search page")
+        return result_count
 
     async def scrape_all_pages(self, page_count: int) -> None:
         """
-        Scrape all SpareRooms pages and store them in self.pages
+        Scrape all SpareRooms pages and store their raw HTML in self.pages
 
         :param page_count: number of pages to scrape
         :return: None
         """
 
-        results = []
-        # Gather all spare_listing urls with offsets
-        urls = [f"{self.url}{i}" for i in range(0, page_count * 10, 10)]
+        # Gather all spare_listing urls with offsets, page 0 was fetched when the search started
+        urls = [f"{self.url}{i}" for i in range(10, page_count * 10, 10)]
+        if page_count > 0:
+            self.pages.append(self.first_page)
 
-        # Using httpx to make async requests
-        async with httpx.AsyncClient() as client:
-            tasks = (client.get(url, timeout=20) for url in urls)
-            results = await asyncio.gather(*tasks)
+        async with self.fetcher as fetcher:
+            results = await fetcher.fetch_all(urls, page_type="search")
 
-        # Convert the results to BS4 objects using lxml
+        # Keep the raw HTML, listing ids are extracted from the bytes directly
         for result in results:
-            soup = Soup(result.text, "lxml")
-            self.pages.append(soup)
+            if not result.ok:
+                self.logger.error("Failed to fetch %s: %s", result.url, result.error)
+                continue
+            self.pages.append(result.content)
 
-        self.logger.debug(f"Scraped {len(self.pages)} pages")
+        self.logger.debug("Scraped %s pages", len(self.pages))
 
-    def get_listing_ids(self, previous_listing_ids=[]):
+    def get_listing_ids(self, previous_listing_ids=None):
         """
         Gets listing ids that are not already scraped and returns a list of listing ids in a quantity less than the predefined limit
 
-        :param previous_listing_ids: list of listing ids that have already been scraped
+        :param previous_listing_ids: KnownListingIds of listings that have already been scraped
         :return: list of listing ids
         """
+        if previous_listing_ids is None:
+            previous_listing_ids = KnownListingIds()
         listing_ids = []
-        for page_soup in self.pages:
-            scraped_listings = page_soup.find_all(
-                "article", class_="panel-listing-result"
-            )
-
-            # Ensure listing-features is not included in scraped_listings
-            scraped_listings = [
-                listing
-                for listing in scraped_listings
-                if "listing-featured" not in str(listing)
-            ]
-
+        for page in self.pages:
             # Check if each id is in the previous listings
-            for index, listing in enumerate(scraped_listings):
-                listing_id = int(
-                    listing.prettify().split("flatshare_id=")[1].split("&")[0]
-                )
+            for index, listing_id in enumerate(self.extract_listing_ids(page)):
                 if listing_id not in previous_listing_ids:
                     listing_ids.append(listing_id)
                     if index == self.limit:
-                        self.logger.info(f"Limit of {self.limit} reached")
+                        self.logger.info("Limit of %s reached", self.limit)
                         break
                 else:
-                    self.logger.debug(f"{listing_id} already logged")
+                    self.logger.debug("%s already logged", listing_id)
 
         return listing_ids
 
+    def extract_listing_ids(self, page) -> list:
+        """
+        Get the ids of the listings on a search results page, excluding featured listings
+
+        Raw HTML goes through the byte-level extractor; Soup objects are walked as before.
+
+        :param page: raw HTML (bytes) or Soup object of search results page
+        :return: list of listing ids
+        """
+        if isinstance(page, (bytes, str)):
+            return extract_listing_ids(page)
+
+        scraped_listings = page.find_all("article", class_="panel-listing-result")
+
+        # Ensure listing-features is not included in scraped_listings
+        return [
+            int(listing.prettify().split("flatshare_id=")[1].split("&")[0])
+            for listing in scraped_listings
+            if "listing-featured" not in str(listing)
+        ]
+
     async def scrape_all_listings(self, listing_ids: list) -> list:
         """
         Scrape all listings using the listing ids
 
         :param listing_ids: list of listing ids
-        :return: list of Listing objects
+        :return: list of raw listing pages (bytes)
         """
-        # Using multiple threads, go through each soup object in pages and get the listing ids to create a list of urls
-        # to scrape
         listings = []
-        urls = [
-            self.domain
-            + "/flatshare/flatshare_detail.pl?flatshare_id="
-            + str(listing_id)
-            for listing_id in listing_ids
-        ]
-        async with httpx.AsyncClient() as client:
-            tasks = (client.get(url, timeout=20) for url in urls)
-            results = await asyncio.gather(*tasks)
+        urls = [self.domain + str(listing_id) for listing_id in listing_ids]
+        async with self.fetcher as fetcher:
+            results = await fetcher.fetch_all(urls, page_type="detail")
 
-        # Use lxml
+        # Keep the raw HTML, the lxml parser works on bytes directly
         for result in results:
-            soup = Soup(result.text, "lxml")
-            listings.append(soup)
+            if not result.ok:
+                self.logger.error("Failed to fetch %s: %s", result.url, result.error)
+                continue
+            listings.append(result.content)
 
         return listings
 
-    def process_listings(self, listings: list) -> list:
-        """
-        Process each listing
-
-        :param listings: list of listings
-        :return: list of processed listings
-        """
-        results = []
-        for listing in listings:
-            results.append(self._convert_to_listing(listing))
-        return results
-
-    def process_listings_threaded(self, listings: list) -> list:
-        """
-        Process each listing in parallel
-
-        :param listings: list of listings
-        :return: list of processed listings
+    def _convert_to_listing(self, listing) -> Listing:
         """
-        with ThreadPoolExecutor() as executor:
-            results = executor.map(self._convert_to_listing, listings)
+        Convert a listing page to a Listing object
 
-        return results
-
-    def _convert_to_listing(self, listing: Soup) -> Listing:
-        """
-        Convert a Beautiful Soup listing object to a Listing object
+        Raw HTML is parsed with the lxml ListingParser, Beautiful Soup objects go through the
+        original Listing constructor.
 
-        :param listing: Soup object of listing
+        :param listing: raw HTML (bytes or str) or Soup object of listing
         :return: Listing object
         """
-        return Listing(listing, self.domain)
+        with metrics.timer("parse"):
+            if isinstance(listing, (bytes, str)):
+                parsed = Listing.from_html(listing, self.domain)
+            else:
+                parsed = Listing(listing, self.domain)
+        metrics.record_listing(parsed)
+        capture.listing(listing, parsed)
+        return parsed
@@ -1,4 +1,6 @@
 """ This module is responsible for constructing the search URL based on the config file. """
+import hashlib
+import re
 from datetime import datetime
 
 
@@ -74,3 +76,12 @@ class SearchConstructor:
     def get_search_url(self):
         """Returns the search URL"""
         return self.search_url
+
+    def get_search_key(self):
+        """
+        Returns a stable key identifying this search across runs
+
+        The available_from filter defaults to today's date, so it is left out of the key.
+        """
+        search_url = re.sub(r"&available_from=[^&]*", "", self.search_url)
+        return hashlib.sha1(search_url.encode("utf-8")).hexdigest()[:16]
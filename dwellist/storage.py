@@ -0,0 +1,505 @@
+""" This module is responsible for storing listings in an indexed SQLite database. """
+import argparse
+import json
+import math
+import sqlite3
+import threading
+from pandas import DataFrame, read_csv
+from dwellist.listing import Listing
+from dwellist.logger import DwellistLogger
+from dwellist.metrics import metrics
+from dwellist.utilities import _reorder_columns
+
+
+class ListingStore:
+    """
+    SQLite listing store
+
+    Listings are upserted by id in batched transactions. The database runs in WAL mode so the
+    web app can read while a scrape is writing. Each row keeps the full listing record as JSON
+    (rooms, images and features nested), with the fields used for filtering (date scraped,
+    latitude, longitude) in their own typed columns.
+    """
+
+    logger = DwellistLogger.get_logger()
+
+    # Ids bound per IN (...) query, below SQLite's default limit on host parameters
+    SQL_VARIABLE_LIMIT = 500
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS listings (
+                id INTEGER PRIMARY KEY,
+                date_scraped TEXT,
+                latitude REAL,
+                longitude REAL,
+                data TEXT NOT NULL
+            )
+            """
+        )
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS crawl_state (
+                search_key TEXT PRIMARY KEY,
+                high_water_id INTEGER NOT NULL,
+                updated_at TEXT NOT NULL
+            )
+            """
+        )
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS searches (
+                search_key TEXT PRIMARY KEY,
+                name TEXT,
+                url TEXT NOT NULL
+            )
+            """
+        )
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS listing_searches (
+                listing_id INTEGER NOT NULL,
+                search_key TEXT NOT NULL,
+                first_seen TEXT NOT NULL,
+                PRIMARY KEY (listing_id, search_key)
+            )
+            """
+        )
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS listing_fingerprints (
+                listing_id INTEGER PRIMARY KEY,
+                fingerprint TEXT NOT NULL,
+                checked_at TEXT NOT NULL
+            )
+            """
+        )
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS price_history (
+                listing_id INTEGER NOT NULL,
+                observed_at TEXT NOT NULL,
+                available INTEGER,
+                min_price_pcm INTEGER,
+                rooms TEXT NOT NULL
+            )
+            """
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS price_history_listing_id ON price_history (listing_id)"
+        )
+        self._connection.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM listings").fetchone()[0]
+
+    def add_listings(self, listings: list) -> int:
+        """
+        Insert or update listings in a single transaction
+
+        A price_history row is appended for every listing that is new, or whose room prices or
+        availability differ from the stored listing.
+
+        :param listings: list of Listing objects
+        :return: number of listings written
+        """
+        return self.upsert_records(
+            (listing.to_record() for listing in listings), track_history=True
+        )
+
+    def upsert_records(self, records, track_history: bool = False) -> int:
+        """
+        Insert or update listing records in a single transaction
+
+        :param records: iterable of Listing records (see Listing.to_record), each with an id
+        :param track_history: append price_history rows for new and changed listings
+        :return: number of records written
+        """
+        rows = [self._to_row(record) for record in records]
+        with metrics.timer("store.upsert"), self._lock, self._connection:
+            if track_history:
+                history = self._history_rows(rows)
+                self._connection.executemany(
+                    """
+                    INSERT INTO price_history (listing_id, observed_at, available, min_price_pcm, rooms)
+                    VALUES (?, datetime('now'), ?, ?, ?)
+                    """,
+                    history,
+                )
+                metrics.increment("store.history_rows", len(history))
+            self._connection.executemany(
+                """
+                INSERT INTO listings (id, date_scraped, latitude, longitude, data)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET
+                    date_scraped = excluded.date_scraped,
+                    latitude = excluded.latitude,
+                    longitude = excluded.longitude,
+                    data = excluded.data
+                """,
+                rows,
+            )
+        metrics.increment("store.rows", len(rows))
+        return len(rows)
+
+    def _history_rows(self, rows: list) -> list:
+        """
+        Get the price_history rows for listing rows about to be upserted, called under the lock
+
+        :param rows: rows from _to_row
+        :return: list of (listing id, available, min price pcm, rooms JSON)
+        """
+        previous = {}
+        listing_ids = [row[0] for row in rows]
+        for start in range(0, len(listing_ids), self.SQL_VARIABLE_LIMIT):
+            chunk = listing_ids[start : start + self.SQL_VARIABLE_LIMIT]
+            previous.update(
+                self._connection.execute(
+                    f"SELECT id, data FROM listings WHERE id IN ({', '.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+            )
+
+        history = []
+        for listing_id, _, _, _, data in rows:
+            record = json.loads(data)
+            rooms = record.get("rooms") or []
+            available = record.get("available")
+            if listing_id in previous:
+                old_record = json.loads(previous[listing_id])
+                if old_record.get("rooms") == rooms and old_record.get("available") == available:
+                    continue
+            prices = [Listing.price_pcm(price) for price, _ in rooms]
+            prices = [price for price in prices if price is not None]
+            history.append(
+                (
+                    listing_id,
+                    None if available is None else int(available),
+                    min(prices) if prices else None,
+                    json.dumps(rooms),
+                )
+            )
+        return history
+
+    def get_price_history(self, listing_id: int) -> list:
+        """
+        Get the recorded prices and availability of a listing, oldest first
+
+        :param listing_id: listing id
+        :return: list of dictionaries with observed_at, available, min_price_pcm and rooms
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                """
+                SELECT observed_at, available, min_price_pcm, rooms FROM price_history
+                WHERE listing_id = ? ORDER BY rowid
+                """,
+                (listing_id,),
+            ).fetchall()
+        return [
+            {
+                "observed_at": observed_at,
+                "available": None if available is None else bool(available),
+                "min_price_pcm": min_price_pcm,
+                "rooms": [tuple(room) for room in json.loads(rooms)],
+            }
+            for observed_at, available, min_price_pcm, rooms in rows
+        ]
+
+    def get_fingerprints(self, listing_ids: list) -> dict:
+        """
+        Get the stored search card fingerprints of listings
+
+        :param listing_ids: listing ids
+        :return: dictionary of listing id to fingerprint, for the listings that have one
+        """
+        fingerprints = {}
+        with self._lock:
+            for start in range(0, len(listing_ids), self.SQL_VARIABLE_LIMIT):
+                chunk = listing_ids[start : start + self.SQL_VARIABLE_LIMIT]
+                fingerprints.update(
+                    self._connection.execute(
+                        f"""
+                        SELECT listing_id, fingerprint FROM listing_fingerprints
+                        WHERE listing_id IN ({', '.join('?' * len(chunk))})
+                        """,
+                        chunk,
+                    ).fetchall()
+                )
+        return fingerprints
+
+    def set_fingerprints(self, fingerprints: dict) -> None:
+        """
+        Record the search card fingerprints of listings
+
+        :param fingerprints: dictionary of listing id to fingerprint
+        """
+        with self._lock, self._connection:
+            self._connection.executemany(
+                """
+                INSERT INTO listing_fingerprints (listing_id, fingerprint, checked_at)
+                VALUES (?, ?, datetime('now'))
+                ON CONFLICT(listing_id) DO UPDATE SET
+                    fingerprint = excluded.fingerprint,
+                    checked_at = excluded.checked_at
+                """,
+                list(fingerprints.items()),
+            )
+
+    def iter_ids(self):
+        """
+        Iterate over the ids of every stored listing without loading them all at once
+
+        Ids are read in chunks of 10000 in id order, each chunk under the lock, so the lock is
+        never held while the caller is iterating.
+
+        :return: generator of listing ids
+        """
+        # Below any listing id, including the -1 of a listing whose id could not be read
+        last_id = -(2**63)
+        while True:
+            with self._lock:
+                rows = self._connection.execute(
+                    "SELECT id FROM listings WHERE id > ? ORDER BY id LIMIT 10000", (last_id,)
+                ).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield row[0]
+            last_id = rows[-1][0]
+
+    def contains(self, listing_id: int) -> bool:
+        """
+        Check whether a listing is stored using the primary key index
+
+        :param listing_id: listing id
+        :return: True if the listing is stored
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT 1 FROM listings WHERE id = ?", (listing_id,)
+            ).fetchone()
+        return row is not None
+
+    def get_existing_ids(self, listing_ids: list) -> set:
+        """
+        Check which of a batch of listings are stored using the primary key index
+
+        :param listing_ids: listing ids
+        :return: set of the ids that are stored
+        """
+        existing = set()
+        with self._lock:
+            for start in range(0, len(listing_ids), self.SQL_VARIABLE_LIMIT):
+                chunk = listing_ids[start : start + self.SQL_VARIABLE_LIMIT]
+                existing.update(
+                    row[0]
+                    for row in self._connection.execute(
+                        f"SELECT id FROM listings WHERE id IN ({', '.join('?' * len(chunk))})",
+                        chunk,
+                    )
+                )
+        return existing
+
+    def get_high_water_mark(self, search_key: str) -> int:
+        """
+        Get the newest listing id seen by the last crawl of a search
+
+        :param search_key: key identifying the search
+        :return: listing id, or None if the search has not been crawled
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT high_water_id FROM crawl_state WHERE search_key = ?", (search_key,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_high_water_mark(self, search_key: str, listing_id: int) -> None:
+        """
+        Record the newest listing id seen by a crawl of a search
+
+        :param search_key: key identifying the search
+        :param listing_id: listing id
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                """
+                INSERT INTO crawl_state (search_key, high_water_id, updated_at)
+                VALUES (?, ?, datetime('now'))
+                ON CONFLICT(search_key) DO UPDATE SET
+                    high_water_id = MAX(high_water_id, excluded.high_water_id),
+                    updated_at = excluded.updated_at
+                """,
+                (search_key, listing_id),
+            )
+
+    def register_search(self, search_key: str, url: str, name: str = None) -> None:
+        """
+        Record the URL and optional name of a search so its matches can be traced back to it
+
+        :param search_key: key identifying the search
+        :param url: search URL
+        :param name: name given to the search in the config
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                """
+                INSERT INTO searches (search_key, name, url) VALUES (?, ?, ?)
+                ON CONFLICT(search_key) DO UPDATE SET name = excluded.name, url = excluded.url
+                """,
+                (search_key, name, url),
+            )
+
+    def record_search_matches(self, search_key: str, listing_ids: list) -> None:
+        """
+        Record that listings appeared in the results of a search
+
+        :param search_key: key identifying the search
+        :param listing_ids: ids of the listings on a search results page
+        """
+        with self._lock, self._connection:
+            self._connection.executemany(
+                """
+                INSERT OR IGNORE INTO listing_searches (listing_id, search_key, first_seen)
+                VALUES (?, ?, datetime('now'))
+                """,
+                [(listing_id, search_key) for listing_id in listing_ids],
+            )
+
+    def get_search_matches(self, listing_id: int) -> list:
+        """
+        Get the searches a listing has appeared in
+
+        :param listing_id: listing id
+        :return: list of search names, or search keys for unnamed searches
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                """
+                SELECT COALESCE(searches.name, listing_searches.search_key)
+                FROM listing_searches
+                LEFT JOIN searches USING (search_key)
+                WHERE listing_searches.listing_id = ?
+                ORDER BY listing_searches.first_seen
+                """,
+                (listing_id,),
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def get_first_search_keys(self) -> dict:
+        """
+        Get the key of the first search each listing appeared in
+
+        :return: dictionary of listing id to search key, for listings matched by a search
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT listing_id, search_key FROM listing_searches ORDER BY first_seen, rowid"
+            ).fetchall()
+        search_keys = {}
+        for listing_id, search_key in rows:
+            search_keys.setdefault(listing_id, search_key)
+        return search_keys
+
+    def get_records(self) -> list:
+        """
+        Get every stored listing
+
+        :return: list of Listing records, in insertion order
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT data FROM listings ORDER BY rowid"
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def get_listings(self) -> list:
+        """
+        Get every stored listing
+
+        :return: list of Listing objects, in insertion order
+        """
+        return [
+            # Rows written before listings had a fixed schema hold the flat csv layout
+            Listing.from_record(record) if "rooms" in record else Listing.from_dict(record)
+            for record in self.get_records()
+        ]
+
+    def to_dataframe(self) -> DataFrame:
+        """
+        Get every stored listing as a DataFrame with the same columns as the csv export
+
+        :return: DataFrame of listings
+        """
+        df = Listing.to_dataframe(self.get_listings())
+        if df.empty:
+            return df
+        return df[_reorder_columns(df.columns)]
+
+    def export_csv(self, file_path: str) -> None:
+        """
+        Write every stored listing to a csv
+
+        :param file_path: path to csv
+        """
+        self.to_dataframe().to_csv(file_path, index=False)
+
+    def import_csv(self, file_path: str, batch_size: int = 5000) -> int:
+        """
+        Import listings from a csv written by add_new_listings
+
+        :param file_path: path to csv
+        :param batch_size: number of rows written per transaction
+        :return: number of listings imported
+        """
+        imported = 0
+        for chunk in read_csv(file_path, chunksize=batch_size):
+            chunk = chunk.dropna(subset=["id"])
+            imported += self.upsert_records(
+                Listing.from_dict(row).to_record() for row in chunk.to_dict("records")
+            )
+        self.logger.info("Imported %s listings from %s", imported, file_path)
+        return imported
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    @staticmethod
+    def _to_row(record: dict) -> tuple:
+        data = {
+            key: None if isinstance(value, float) and math.isnan(value) else value
+            for key, value in record.items()
+        }
+        data["id"] = int(data["id"])
+        return (
+            data["id"],
+            data.get("date_scraped"),
+            data.get("latitude"),
+            data.get("longitude"),
+            json.dumps(data, default=str),
+        )
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description="Import listings from a Dwellist csv into a SQLite listing store"
+    )
+    arg_parser.add_argument("csv_path", help="csv written by a previous scrape")
+    arg_parser.add_argument("database_path", help="SQLite database to create or update")
+    args = arg_parser.parse_args()
+
+    store = ListingStore(args.database_path)
+    store.import_csv(args.csv_path)
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,9 @@
+import os
 from pandas import DataFrame, read_csv
 from pandas import concat as concatenate
 from pandas.errors import EmptyDataError
 from dwellist.listing import Listing
+from dwellist.schema import schema
 
 
 def print_title():
@@ -11,6 +13,18 @@ def print_title():
     print(title)
 
 
+def get_data_path(filename: str) -> str:
+    """
+    Get the path of a file in the dwellist data directory, creating the directory if needed
+
+    :param filename: name of the file
+    :return: path to the file
+    """
+    data_directory = os.path.join(os.getcwd(), "dwellist", "data")
+    os.makedirs(data_directory, exist_ok=True)
+    return os.path.join(data_directory, filename)
+
+
 def get_existing_listings(file_path: str) -> DataFrame:
     """
     Get existing listings from csv
@@ -25,6 +39,19 @@ def get_existing_listings(file_path: str) -> DataFrame:
     return df
 
 
+def get_csv_columns(file_path: str) -> list:
+    """
+    Get the header of a csv without reading its rows
+
+    :param file_path: path to csv
+    :return: list of columns, empty if the csv does not exist or is empty
+    """
+    try:
+        return list(read_csv(file_path, nrows=0).columns)
+    except (FileNotFoundError, EmptyDataError):
+        return []
+
+
 def add_new_listing(
     existing_listings: DataFrame, new_listing: Listing, file_path: str
 ) -> None:
@@ -36,7 +63,7 @@ def add_new_listing(
     :param file_path: path to csv
     :return: None
     """
-    new_df = DataFrame([new_listing.__dict__])
+    new_df = Listing.to_dataframe([new_listing])
 
     if existing_listings is None or existing_listings.empty:
         combined_df = new_df
@@ -51,19 +78,21 @@ def add_new_listing(
 
 def add_new_listings(
     existing_listings: DataFrame, new_listings: list, file_path: str
-) -> None:
+) -> DataFrame:
     """
     Add new listings to the listings DataFrame
 
     :param existing_listings: DataFrame of existing listings
     :param new_listings: list of Listing objects of new listings
     :param file_path: path to csv
-    :return: None
+    :return: DataFrame of all listings saved to the csv
     """
-    new_listings_df = DataFrame([new_listing.__dict__ for new_listing in new_listings])
+    new_listings_df = Listing.to_dataframe(new_listings)
 
     # If there are no existing listings, just use the new listings
-    if existing_listings is not None or not existing_listings.empty:
+    if existing_listings is None or existing_listings.empty:
+        updated_listings_df = new_listings_df
+    else:
         updated_listings_df = concatenate(
             [existing_listings, new_listings_df], ignore_index=True
         )
@@ -74,27 +103,38 @@ def add_new_listings(
     updated_listings_df = updated_listings_df[reordered_columns]
     # Save the DataFrame to the csv
     updated_listings_df.to_csv(file_path, index=False)
+    return updated_listings_df
+
+
+def append_new_listings(columns: list, new_listings: list, file_path: str) -> list:
+    """
+    Append new listings to the csv without rewriting the rows already in it
+
+    The rows are appended under the csv's existing header. Only when the new listings bring a
+    column the csv does not have yet is the whole file read back and rewritten with the new
+    header, so saving a batch normally costs the size of the batch, not of the csv.
+
+    :param columns: columns of the csv, empty if it does not exist yet
+    :param new_listings: list of Listing objects of new listings
+    :param file_path: path to csv
+    :return: columns of the csv after the write
+    """
+    new_listings_df = Listing.to_dataframe(new_listings)
+    if columns and set(new_listings_df.columns) <= set(columns):
+        new_listings_df.reindex(columns=columns).to_csv(
+            file_path, mode="a", header=False, index=False
+        )
+        return columns
+
+    existing_listings = get_existing_listings(file_path) if columns else None
+    return list(add_new_listings(existing_listings, new_listings, file_path).columns)
 
 
 def _reorder_columns(columns: list) -> list:
     """
-    Reorder columns
+    Reorder columns into the csv layout: listing_, deposit and image columns last
 
     :param columns: list of columns
     :return: list of reordered columns
     """
-    listing_columns = [col for col in columns if col.startswith("listing_")]
-    deposit_columns = [col for col in columns if col.startswith("deposit")]
-    image_columns = [col for col in columns if col.startswith("image")]
-    non_listing_columns = [
-        col
-        for col in columns
-        if (col not in listing_columns + deposit_columns + image_columns)
-    ]
-
-    reordered_columns = non_listing_columns
-    reordered_columns.extend(listing_columns)
-    reordered_columns.extend(deposit_columns)
-    reordered_columns.extend(image_columns)
-
-    return reordered_columns
+    return schema.order(list(columns))
@@ -0,0 +1,30 @@
+"""
+Gunicorn settings for serving the Dwellist web app
+
+Every setting can be overridden from the environment, e.g. WEB_CONCURRENCY=8. Send SIGHUP to the
+master to replace the workers gracefully; changes to the listings csv are picked up without a
+reload.
+"""
+import multiprocessing
+import os
+
+bind = f"{os.environ.get('HOST', '0.0.0.0')}:{os.environ.get('PORT', '5000')}"
+
+# Worker processes, each serving requests on a pool of threads
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+
+# Import the app in the master so the marker cache is built once and shared by the workers
+preload_app = True
+
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 30))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", 30))
+keepalive = 5
+
+# Recycle workers now and again to bound memory growth
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 10000))
+max_requests_jitter = max_requests // 10
+
+accesslog = os.environ.get("GUNICORN_ACCESS_LOG", "-")
+errorlog = "-"
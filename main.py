@@ -7,11 +7,21 @@ Barebones taken from afspies; modified, updated and improved by a-curious-coder
 import json
 import os
 import time
+from dwellist.capture import capture
+from dwellist.dataset import ListingDataset
+from dwellist.fetcher import AsyncFetcher
 from dwellist.scraper import SpareRoomScraper
+from dwellist.pipeline import ScrapePipeline
 from dwellist.logger import DwellistLogger
+from dwellist.metrics import metrics
+from dwellist.known_ids import BloomKnownListingIds, KnownListingIds, load_known_ids
+from dwellist.storage import ListingStore
 from dwellist.utilities import (
     print_title,
     add_new_listings,
+    append_new_listings,
+    get_csv_columns,
+    get_data_path,
     get_existing_listings,
 )
 import asyncio
@@ -19,40 +29,26 @@ import asyncio
 logger = DwellistLogger.get_logger()
 
 
-def process_next_ten_listings(args) -> bool:
-    spare_listing, existing_listings_df, filepath, counter = args
-    new_listings = spare_listing.get_next_ten_listings(
-        previous_listings=existing_listings_df, input=counter
-    )
-
-    if new_listings is None:
-        return False
-
-    # Remove listings that are None
-    new_listings = [listing for listing in new_listings if listing is not None]
-
-    # Filter out listings that already exist in the spreadsheet
-    filtered_new_listings = [
-        listing
-        for listing in new_listings
-        if existing_listings_df.empty
-        or listing.id not in existing_listings_df["id"].values
-    ]
-    # Append new listings to the spreadsheet
-    get_existing_listings(existing_listings_df, filtered_new_listings, filepath)
-    return True
-
+def get_new_listings(scraper, existing_listings_df, filepath) -> list:
+    """
+    Crawl a search with worker threads and save the new listings in one write
 
-def get_new_listings(scraper, existing_listings_df, filename):
-    counter = 0
-    while process_next_ten_listings((scraper, existing_listings_df, filename, counter)):
-        counter += 1
+    :param scraper: SpareRoomScraper for the search
+    :param existing_listings_df: DataFrame of the listings already saved
+    :param filepath: path to csv
+    :return: list of new Listing objects
+    """
+    known_ids = KnownListingIds.from_dataframe(existing_listings_df)
+    new_listings = scraper.crawl_threaded(known_ids)
+    if new_listings:
+        add_new_listings(existing_listings_df, new_listings, filepath)
+    return new_listings
 
 
 def scrape_listings_slow(config):
     # ! Get existing listings locally
     filename = config["filename"]
-    filepath = os.path.join(os.getcwd(), "dwellist\\data\\" + filename)
+    filepath = get_data_path(filename)
     # Read the existing listings from the spreadsheet
     existing_listings_df = get_existing_listings(filepath)
 
@@ -64,62 +60,176 @@ def scrape_listings_slow(config):
     get_new_listings(scraper, existing_listings_df, filepath)
 
 
-def scrape_listings_fast(config):
-    scraper = SpareRoomScraper(config)
-    # ! Get number of pages we want to scrape
+def open_listing_store(config) -> ListingStore:
+    """
+    Open the SQLite listing store, importing the existing csv the first time it is created
+
+    :param config: search config
+    :return: ListingStore
+    """
+    store = ListingStore(get_data_path(config["database"]))
+    csv_path = get_data_path(config["filename"])
+    if len(store) == 0 and os.path.exists(csv_path):
+        store.import_csv(csv_path)
+    return store
+
+
+def get_page_count(scraper, config) -> int:
+    """
+    Get the number of search pages to crawl for a search
+
+    :param scraper: SpareRoomScraper for the search
+    :param config: search config
+    :return: number of search pages
+    """
     scrapable_listing_count = scraper.get_total_results()
-    page_count = (
-        scrapable_listing_count // 10
-        if scrapable_listing_count < config["listings_to_scrape"]
-        else config["listings_to_scrape"] // 10
-    )
+    return -(-min(scrapable_listing_count, config["listings_to_scrape"]) // 10)
 
-    # ! Scrape the pages
-    asyncio.run(scraper.scrape_all_pages(page_count))
 
+async def run_pipeline(config, searches, fetcher) -> int:
+    """
+    Stream new listings from one or more searches through to storage
+
+    :param config: scraper settings
+    :param searches: list of (SpareRoomScraper, number of search pages to crawl)
+    :param fetcher: AsyncFetcher shared by the searches
+    :return: number of listings saved
+    """
     # ! Create filepath for listings
     filename = config["filename"]
-    filepath = os.path.join(os.getcwd(), "dwellist\\data\\" + filename)
+    filepath = get_data_path(filename)
+    metrics.reset()
+
+    store = None
+    if config.get("database"):
+        # ! Upsert listings into the SQLite store and append the new ones to the csv. The csv
+        # ! is only exported in full when it is missing or listings already in it changed
+        store = open_listing_store(config)
+        existing_listing_ids = load_known_ids(config, store=store)
+        csv_columns = get_csv_columns(filepath)
+        export_csv = not csv_columns and len(store) > 0
+
+        def persist(listings):
+            nonlocal csv_columns, export_csv
+            new_listings = [
+                listing for listing in listings if listing.id not in existing_listing_ids
+            ]
+            store.add_listings(listings)
+            if len(new_listings) < len(listings):
+                export_csv = True
+            elif not export_csv:
+                csv_columns = append_new_listings(csv_columns, new_listings, filepath)
+
+        for scraper, _ in searches:
+            store.register_search(
+                scraper.search_key, scraper.url_search, scraper.config.get("name")
+            )
+    else:
+        # ! Get existing listing ids
+        existing_listings_df = get_existing_listings(filepath)
+        existing_listing_ids = load_known_ids(config, listings=existing_listings_df)
+
+        # ! Append each batch to the csv rather than rewriting it
+        csv_columns = list(existing_listings_df.columns)
+        del existing_listings_df
+
+        def persist(listings):
+            nonlocal csv_columns
+            csv_columns = append_new_listings(csv_columns, listings, filepath)
+
+    if config.get("dataset_dir"):
+        # ! Also append each batch to the partitioned Parquet dataset
+        dataset = ListingDataset(config["dataset_dir"])
+        save_listings = persist
+
+        def persist(listings):
+            save_listings(listings)
+            dataset.append(listings, search_keys=pipeline.seen)
+
+    # ! Stream new listings from the search pages through to storage
+    start = time.perf_counter()
+    pipeline = ScrapePipeline(
+        fetcher, persist, existing_listing_ids, config, crawl_state=store
+    )
+    saved = await pipeline.run(searches)
 
-    # ! Get existing listing ids
-    existing_listings_df = get_existing_listings(filepath)
-    existing_listing_ids = (
-        existing_listings_df["id"].values.tolist()
-        if not existing_listings_df.empty
-        else []
+    end = time.perf_counter()
+    elapsed = f"{end - start:.2f}"
+    logger.debug("Scraped and saved %s listings in %s seconds", saved, elapsed)
+
+    if store is not None:
+        if export_csv:
+            with metrics.timer("export_csv"):
+                store.export_csv(filepath)
+        if isinstance(existing_listing_ids, BloomKnownListingIds):
+            existing_listing_ids.save()
+        store.close()
+
+    # ! Write where the run spent its time for the web app's /metrics endpoint
+    metrics.write_summary(
+        get_data_path(config.get("run_summary", "run_summary.json")),
+        searches=[scraper.config.get("name") or scraper.search_key for scraper, _ in searches],
+        listings_saved=saved,
+        search_pages=pipeline.pages_fetched,
+        pipeline_seconds=round(end - start, 3),
     )
+    return saved
 
-    # ! Get new listing ids from SpareRoom
-    listing_ids = scraper.get_listing_ids(existing_listing_ids)
 
-    if len(listing_ids) > 0:
-        # ! Scrape all new listing listings
-        start = time.perf_counter()
+async def scrape_searches(settings, search_configs) -> int:
+    """
+    Start every search and stream their listings to storage in one event loop
 
-        listings = asyncio.run(scraper.scrape_all_listings(listing_ids))
+    The searches are started concurrently, and their first results pages are reused as page 0
+    of the crawl. One fetcher, and so one connection pool, serves the whole run.
 
-        end = time.perf_counter()
-        elapsed = f"{end - start:.2f}"
-        logger.debug("Scrape time: %s seconds", elapsed)
-
-        # ! Preprocess each listing listing and save each to spreadsheet
-        logger.debug(f"Processing {len(listings)} listings")
-        results = scraper.process_listings_threaded(listings)
-
-        # TODO: Remove this when saving each property to spreadsheet
-        filtered_new_listings = [
-            listing
-            for listing in results
-            if existing_listings_df.empty
-            or listing.id not in existing_listings_df["id"].values
+    :param settings: scraper settings
+    :param search_configs: search config of each search
+    :return: number of listings saved
+    """
+    fetcher = AsyncFetcher(settings)
+
+    async def prepare_search(search_config):
+        try:
+            scraper = await SpareRoomScraper.create(search_config, fetcher=fetcher)
+            return scraper, get_page_count(scraper, search_config)
+        except Exception as e:
+            logger.error("Skipping search %s: %s", search_config.get("name"), e)
+            return None
+
+    async with fetcher:
+        # ! Discover each search's page count concurrently
+        searches = [
+            search
+            for search in await asyncio.gather(*map(prepare_search, search_configs))
+            if search
         ]
-        add_new_listings(existing_listings_df, filtered_new_listings, filepath)
+        if len(search_configs) > 1:
+            logger.info("Running %s of %s searches", len(searches), len(search_configs))
+        return await run_pipeline(settings, searches, fetcher)
+
+
+def scrape_listings_fast(config):
+    asyncio.run(scrape_searches(config, [config]))
+
+
+def scrape_listings_batch(config):
+    """
+    Run every search in config["searches"] over one shared fetcher, cache and listing store
+
+    Each search is the top level config with the search's own values layered on top. A listing
+    matched by several searches has its detail page fetched once, and with a database every
+    search it matched is recorded.
+    """
+    settings = {key: value for key, value in config.items() if key != "searches"}
+    search_configs = [{**settings, **search} for search in config["searches"]]
+    asyncio.run(scrape_searches(settings, search_configs))
 
 
 def test_scrape_listings_processes(config):
     # If there are existing listings, rename the file to a backup
     filename = config["filename"]
-    filepath = os.path.join(os.getcwd(), "dwellist\\data\\" + filename)
+    filepath = get_data_path(filename)
     if os.path.exists(filepath):
         os.rename(filepath, filepath + ".bak")
 
@@ -158,6 +268,8 @@ def main():
     try:
         with open("test_config.json", "r", encoding="utf-8") as config_file:
             config = json.load(config_file)
+        DwellistLogger.configure(config)
+        capture.configure(config)
 
         os.system("cls" if os.name == "nt" else "clear")
         print_title()
@@ -165,7 +277,10 @@ def main():
             test_scrape_listings_processes(config)
         # ! Scrape listings fast
         start = time.perf_counter()
-        scrape_listings_fast(config)
+        if "searches" in config:
+            scrape_listings_batch(config)
+        else:
+            scrape_listings_fast(config)
         end = time.perf_counter()
         elapsed = f"{end - start:.2f}"
         logger.info("Listings scraped: %s seconds", elapsed)
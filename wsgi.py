@@ -0,0 +1,13 @@
+"""
+WSGI entry point for production servers
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+"""
+from app import create_app
+from app.main.routes import marker_cache
+
+app = create_app()
+
+# Loaded once in the gunicorn master (preload_app), so the marker payload, index and clusters
+# are built before the workers fork and shared between them
+marker_cache.preload()